@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+#
+# Refit a stage's memory config from recorded runs. The csv has one row per run, a column for each size term
+# of the stage's config (named as in the config, e.g. mem_per_voxel and mem_per_size for stacks_to_volume:
+# the output voxels held and the full resolution pixels per worker, as its set_mem hook counts them) and
+# peak_mem, the run's peak memory in GB (e.g. "Maximum resident set size" from /usr/bin/time -v / 2**20).
+# Prints the fitted config to paste over the default in core/reconstruction.py.
+#
+#   python benchmarks/fit_memory.py stacks_to_volume runs.csv [--headroom 1.2]
+
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+from core.reconstruction import TVStitchMemCfg, DeepSegmentMemCfg, StacksToVolumeMemCfg, fit_mem_cfg
+
+MEM_CFGS = {"TV_stitch": TVStitchMemCfg, "deep_segment": DeepSegmentMemCfg, "stacks_to_volume": StacksToVolumeMemCfg}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit a stage's memory config to the peak memory of recorded runs.")
+    parser.add_argument("stage", choices=sorted(MEM_CFGS))
+    parser.add_argument("runs_csv", type=str)
+    parser.add_argument("--headroom", type=float, default=1.2,
+                        help="Factor the fitted coefficients are scaled by [default = %(default)s]")
+    args = parser.parse_args()
+
+    mem_cfg_type = MEM_CFGS[args.stage]
+    terms = [field for field in mem_cfg_type._fields if field != "base_mem"]
+    runs = pd.read_csv(args.runs_csv)
+    missing = [column for column in terms + ["peak_mem"] if column not in runs.columns]
+    if missing:
+        parser.error("%s is missing the columns %s" % (args.runs_csv, ", ".join(missing)))
+    if len(runs) <= len(terms):
+        parser.error("%d runs are too few to fit %d coefficients" % (len(runs), len(terms) + 1))
+    print(fit_mem_cfg(mem_cfg_type, runs[terms].values, runs.peak_mem.values, args.headroom))
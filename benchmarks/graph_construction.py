@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# Time how long TV_minc_recon.py takes to build its stage graph (nothing is run) for synthetic cohorts of
+# 10k to 100k slices:
+#
+#   python benchmarks/graph_construction.py [--slices 10000 50000 100000] [--slices-per-brain 300]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+import pandas as pd
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [repository, os.path.join(repository, "pipelines")]
+from TV_minc_recon import minc_recon
+
+def synthetic_slices(n_slices, slices_per_brain, directory):
+    """A TV_slices.csv for n_slices slices, split into brains of slices_per_brain slices."""
+    brain = [i // slices_per_brain for i in range(n_slices)]
+    z = [i % slices_per_brain + 1 for i in range(n_slices)]
+    brain_name = ["brain%04d" % b for b in brain]
+    return pd.DataFrame({
+        "brain_name": brain_name,
+        "brain_directory": [os.path.join(directory, "raw", name) for name in brain_name],
+        "Zstart": 1,
+        "Zend": slices_per_brain,
+        "number_of_slices": slices_per_brain,
+        "interslice_distance": [0.05 + 0.025 * (b % 3) for b in brain],
+        "slice_directory": [os.path.join(directory, "stitched", name) for name in brain_name],
+        "slice": [os.path.join(directory, "stitched", name, "%s_Z%04d.tif" % (name, i))
+                  for name, i in zip(brain_name, z)],
+    })
+
+def synthetic_options(output_dir):
+    return Namespace(
+        application=Namespace(output_directory=output_dir, pipeline_name="benchmark"),
+        deep_segment=Namespace(deep_segment_pipeline=os.path.join(output_dir, "learner.pkl"),
+                               anatomical_name="cropped", count_name="count", outline_name="outline",
+                               qc_fraction=0.1, cell_min_area=None, cell_mean_area=None, cell_max_area=None,
+                               temp_dir=None),
+        stacks_to_volume=Namespace(input_resolution=0.00137, plane_resolution=0.025,
+                                   manual_scale_output=False, incremental=False,
+                                   stream=False, strip_rows=None, processes=1))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time TV_minc_recon.py's stage graph construction")
+    parser.add_argument("--slices", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--slices-per-brain", dest="slices_per_brain", type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # minc_recon writes its csvs to the working directory
+        os.chdir(directory)
+        for n_slices in args.slices:
+            csv_file = os.path.join(directory, "TV_slices.csv")
+            synthetic_slices(n_slices, args.slices_per_brain, directory).to_csv(csv_file, index=False)
+            slices_df = pd.read_csv(csv_file,
+                                    dtype={"brain_name": str, "brain_directory": str, "slice_directory": str})
+            start = time.perf_counter()
+            result = minc_recon(slices_df, synthetic_options(directory))
+            print("%7d slices: %6.2f s, %d stages" % (n_slices, time.perf_counter() - start, len(result.stages)))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+#
+# A manual check, run by hand after changing a tool's imports (it isn't part of any test suite), that the
+# command line tools run once per stage still start quickly. Each is imported in a fresh interpreter; a tool
+# fails if the import takes longer than the budget or loads any of the heavy modules that only some of its
+# code paths need. Exits non-zero if any tool fails.
+#
+#   python benchmarks/import_time.py [--budget 1.0] [--tools TV_stitch MIP_first]
+
+import argparse
+import os
+import subprocess
+import sys
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["fastai", "torch", "pandas", "scipy.stats"]
+
+CHECK = """
+import sys, time
+sys.path.insert(0, {tools!r})
+start = time.perf_counter()
+import {tool}
+print(time.perf_counter() - start)
+print(" ".join(module for module in {heavy!r} if module in sys.modules))
+"""
+
+def import_time(tool):
+    """The seconds it takes a fresh interpreter to import tool, and the heavy modules that import loaded."""
+    output = subprocess.run([sys.executable, "-c", CHECK.format(tools=os.path.join(repository, "tools"),
+                                                                  tool=tool, heavy=HEAVY_MODULES)],
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.splitlines()
+    return float(output[0]), output[1].split()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the startup time of the per-stage command line tools")
+    parser.add_argument("--budget", type=float, default=1.0,
+                        help="Seconds each import may take [default = %(default)s]")
+    parser.add_argument("--tools", type=str, nargs="+", default=["TV_stitch", "MIP_first"])
+    args = parser.parse_args()
+
+    failed = False
+    for tool in args.tools:
+        seconds, loaded = import_time(tool)
+        ok = seconds <= args.budget and not loaded
+        failed |= not ok
+        print("%-12s %5.2f s%s  %s" % (tool, seconds, " (loaded %s)" % ", ".join(loaded) if loaded else "",
+                                      "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
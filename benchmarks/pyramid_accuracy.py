@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+#
+# Check stacks_to_volume.py's --pyramid Gaussian downsampling against filtering the full resolution axis with
+# gaussian_filter1d and point sampling it, for white noise (the worst case for aliasing) and a smooth image.
+# The RMS difference at each downsampling ratio, relative to the standard deviation of the reference, must
+# stay within the tolerance. Exits non-zero if any ratio doesn't.
+#
+#   python benchmarks/pyramid_accuracy.py [--ratios 2 4 8 16 32 64] [--tolerance 0.001]
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import scipy.ndimage
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repository, "tools"))
+from stacks_to_volume import pyramid_octaves, pyramid_reduce_axis
+
+def test_images(length, width=32, seed=0):
+    """White noise and a sum of a few smooth waves, each length pixels along the axis being reduced."""
+    rng = np.random.default_rng(seed)
+    noise = rng.random((length, width))
+    position = np.arange(length)[:, None] / length
+    smooth = sum(np.sin(2 * np.pi * (frequency * position + rng.random(width)))
+                 for frequency in (1.5, 7, 23))
+    return {"noise": noise, "smooth": smooth}
+
+def relative_error(image, ratio):
+    """The RMS difference between the pyramid and gaussian_filter1d, relative to the latter's standard deviation."""
+    # the sample points and sigma stacks_to_volume.py uses for an output grid ratio times coarser
+    centres = np.round(np.arange(image.shape[0] // ratio) * ratio).astype(int)
+    sigma = float(ratio)
+    reference = scipy.ndimage.gaussian_filter1d(image, sigma, axis=0).take(centres, 0)
+    pyramid = pyramid_reduce_axis(image, 0, [(centres, sigma, pyramid_octaves(ratio, sigma))])[0]
+    return np.sqrt(np.mean((pyramid - reference) ** 2)) / reference.std()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the --pyramid Gaussian downsampling of stacks_to_volume.py "
+                                                 "with gaussian_filter1d.")
+    parser.add_argument("--ratios", nargs="+", type=int, default=[2, 4, 8, 16, 32, 64],
+                        help="Downsampling ratios to check [default = %(default)s]")
+    parser.add_argument("--length", type=int, default=8192,
+                        help="Pixels along the reduced axis [default = %(default)s]")
+    parser.add_argument("--tolerance", type=float, default=0.001,
+                        help="Largest acceptable relative RMS error [default = %(default)s]")
+    args = parser.parse_args()
+
+    failed = False
+    for name, image in test_images(args.length).items():
+        for ratio in args.ratios:
+            error = relative_error(image, ratio)
+            failed |= error > args.tolerance
+            print("%-7s ratio %3d: %d octaves, relative RMS error %.5f%s"
+                  % (name, ratio, pyramid_octaves(ratio, float(ratio)), error,
+                     "" if error <= args.tolerance else "  (over %g)" % args.tolerance))
+    sys.exit(1 if failed else 0)
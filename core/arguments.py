@@ -11,6 +11,19 @@ def _mk_TV_stitch_parser():
     p.add_argument("--keep-stitch-tmp", dest="keep_tmp",
                    action="store_true", default=False,
                    help="Keep temporary files from TV_stitch.")
+    p.add_argument("--piezo-projection", dest="projection",
+                   type=str, choices=["max", "mean"],
+                   default=None,
+                   help="Project the piezo layers of each tile while stitching, instead of running MIP_first.py "
+                        "to write a projected copy of the acquisition beforehand. Use mean rather than a sum, "
+                        "which would outgrow the tiles' type.")
+    p.add_argument("--chunk-size", dest="chunk_size",
+                   type=int,
+                   default=None,
+                   help="Stitch this many slices per TV_stitch.py stage, so that later stages can start on them "
+                        "before the whole brain is stitched. The tiles of a chunked brain are registered once, "
+                        "in a stage of their own, and every chunk is placed from the saved positions. "
+                        "[default = the whole brain in one stage]")
     return p
 TV_stitch_parser = AnnotatedParser(parser=BaseParser(_mk_TV_stitch_parser(), "TV_stitch"),
                                    namespace="TV_stitch")
@@ -92,6 +105,23 @@ def _mk_stacks_to_volume_parser():
                         "the minimum interslice distance of all brains. Each brain's scalar value will be reflected "
                         "in the output csv files."
                    )
+    p.add_argument("--incremental", dest="incremental",
+                   action="store_true", default=False,
+                   help="Keep a manifest of the slices next to each stacked volume and, when the pipeline is rerun "
+                        "after a few slices were redone, only reprocess those slices and overwrite them in the "
+                        "existing volume instead of rebuilding it. [default = %(default)s]")
+    p.add_argument("--stream", dest="stream",
+                   action="store_true", default=False,
+                   help="Write each slice to the stacked volumes as soon as it is done instead of holding the "
+                        "volumes in memory (always the case with --incremental). [default = %(default)s]")
+    p.add_argument("--strip-rows", dest="strip_rows",
+                   type=int, default=None,
+                   help="Read and filter each full resolution slice this many output rows at a time instead of "
+                        "reading whole slices into memory. [default = whole slices]")
+    p.add_argument("--stacks-to-volume-processes", dest="processes",
+                   type=int, default=1,
+                   help="Number of slices each stacks_to_volume.py stage processes in parallel. "
+                        "[default = %(default)s]")
     return p
 stacks_to_volume_parser = AnnotatedParser(parser=BaseParser(_mk_stacks_to_volume_parser(), "stacks_to_volume"),
                                       namespace="stacks_to_volume")
@@ -127,6 +157,35 @@ def _mk_consensus_to_atlas_parser():
                    type=str,
                    default=None,
                    help="Register the consensus average to the ABI Atlas")
+    p.add_argument("--batch-resample", dest="batch_resample",
+                   action="store_true", default=False,
+                   help="Resample each subject's anatomical and count volumes to the atlas in one stage that "
+                        "evaluates their shared transform once, instead of a mincresample per image. "
+                        "[default = %(default)s]")
+    p.add_argument("--single-resample-counts", dest="single_resample_counts",
+                   action="store_true", default=False,
+                   help="Resample the native count volumes to the atlas in one pass, through their lsq6 and "
+                        "lsq6-to-atlas transforms composed, instead of through lsq6 space. Regional counts are "
+                        "then computed on the native counts, with the atlas labels resampled onto them, since "
+                        "interpolated counts wouldn't add up to the same totals. [default = %(default)s]")
+    p.add_argument("--write-lsq6-counts", dest="write_lsq6_counts",
+                   action="store_true", default=False,
+                   help="With --single-resample-counts, still write the count volumes resampled to lsq6 space "
+                        "(and compute regional counts there). [default = %(default)s]")
+    p.add_argument("--regional-counts-processes", dest="regional_counts_processes",
+                   type=int,
+                   default=1,
+                   help="Number of subjects whose regional cell counts are computed in parallel. "
+                        "[default = %(default)s]")
+    p.add_argument("--count-blur-fwhms", dest="count_blur_fwhms",
+                   type=lambda x: [float(fwhm) for fwhm in x.split(',')],
+                   default=[],
+                   help="Comma separated FWHMs (mm) at which to blur every count volume in atlas space, "
+                        "e.g. 0.1,0.2. [default = %(default)s]")
+    p.add_argument("--blur-processes", dest="blur_processes",
+                   type=int,
+                   default=1,
+                   help="Number of count volumes blurred in parallel. [default = %(default)s]")
     return p
 consensus_to_atlas_parser = AnnotatedParser(parser=BaseParser(_mk_consensus_to_atlas_parser(), 'consensus_to_atlas'),
                                             namespace='consensus_to_atlas')
\ No newline at end of file
@@ -0,0 +1,92 @@
+import os
+from typing import List
+
+import numpy as np
+
+from pydpiper.core.util import NamedTuple
+
+MincHeader = NamedTuple("MincHeader",
+                        [('dimnames', List[str]),
+                         ('sizes', np.ndarray),
+                         ('starts', np.ndarray),
+                         ('separations', np.ndarray)])
+
+WORLD_AXES = ("xspace", "yspace", "zspace")
+
+# headers already read, keyed by (absolute path, modification time) so a rewritten file is read again
+_headers = {}
+
+def _attribute(attrs, name, default):
+    return float(np.asarray(attrs[name]).ravel()[0]) if name in attrs else default
+
+def _read_header_h5py(path: str) -> MincHeader:
+    import h5py
+    with h5py.File(path, "r") as f:
+        image = f["minc-2.0/image/0/image"]
+        dimorder = image.attrs["dimorder"]
+        dimnames = (dimorder.decode() if isinstance(dimorder, bytes) else str(dimorder)).split(",")
+        dimnames = [dimname for dimname in dimnames if dimname != "vector_dimension"]
+        dimensions = f["minc-2.0/dimensions"]
+        return MincHeader(dimnames=dimnames,
+                          sizes=np.array(image.shape[:len(dimnames)]),
+                          starts=np.array([_attribute(dimensions[d].attrs, "start", 0.0) for d in dimnames]),
+                          separations=np.array([_attribute(dimensions[d].attrs, "step", 1.0) for d in dimnames]))
+
+def _read_header_pyminc(path: str) -> MincHeader:
+    from pyminc.volumes.factory import volumeFromFile
+    vol = volumeFromFile(path)
+    try:
+        return MincHeader(dimnames=list(vol.dimnames),
+                          sizes=np.array(vol.sizes[:len(vol.dimnames)]),
+                          starts=np.array(vol.starts),
+                          separations=np.array(vol.separations))
+    finally:
+        vol.closeVolume()
+
+def minc_header(path: str) -> MincHeader:
+    """
+    The dimension names, sizes, starts and separations of a MINC volume, read from its header alone (with
+    h5py for MINC2 files, through pyminc otherwise) and cached for as long as the file is unchanged.
+    """
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+    if key not in _headers:
+        try:
+            header = _read_header_h5py(path)
+        except (ImportError, OSError, KeyError):
+            # h5py is missing or this isn't a MINC2 file
+            header = _read_header_pyminc(path)
+        _headers[key] = header
+    return _headers[key]
+
+def _direction_cosines_h5py(path: str, dimnames: List[str]) -> np.ndarray:
+    import h5py
+    with h5py.File(path, "r") as f:
+        dimensions = f["minc-2.0/dimensions"]
+        return np.array([np.asarray(dimensions[d].attrs["direction_cosines"], dtype=float).ravel()
+                         if "direction_cosines" in dimensions[d].attrs else np.eye(3)[WORLD_AXES.index(d)]
+                         for d in dimnames])
+
+def _direction_cosines_mincinfo(path: str, dimnames: List[str]) -> np.ndarray:
+    import subprocess
+    cosines = []
+    for d in dimnames:
+        try:
+            value = subprocess.run(["mincinfo", "-attvalue", "%s:direction_cosines" % d, path],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                                   universal_newlines=True).stdout
+            cosines.append([float(v) for v in value.split()])
+        except subprocess.CalledProcessError:
+            # a dimension without direction cosines lies along its own world axis
+            cosines.append(np.eye(3)[WORLD_AXES.index(d)])
+    return np.array(cosines)
+
+def minc_direction_cosines(path: str) -> np.ndarray:
+    """
+    The direction cosines of each spatial dimension of a MINC volume, in minc_header's dimension order, one
+    row of x, y and z components per dimension (the dimension's own world axis where none are recorded).
+    """
+    dimnames = [dimname for dimname in minc_header(path).dimnames if dimname in WORLD_AXES]
+    try:
+        return _direction_cosines_h5py(path, dimnames)
+    except (ImportError, OSError, KeyError):
+        return _direction_cosines_mincinfo(path, dimnames)
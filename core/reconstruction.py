@@ -8,11 +8,63 @@ from pydpiper.core.files import FileAtom
 from pydpiper.minc.files import MincAtom, XfmAtom
 from pydpiper.core.util import NamedTuple
 
-import pyminc.volumes.factory as pyminc
-
 import numpy as np
 
+from core.minc_header import minc_header
+
+
+
+# memory (in GB) that each stage reserves: base_mem plus mem_per_size for every pixel (or voxel) it works on.
+# The defaults are rough estimates, not fits: they count the bytes of the copies each tool makes of what it
+# works on (noted beside each), with some allowance for the interpreter and libraries in base_mem. Refit them
+# with fit_mem_cfg (see benchmarks/fit_memory.py) from the peak memory of recorded runs.
+TVStitchMemCfg = NamedTuple("TVStitchMemCfg",
+                            [('base_mem', float),
+                             ('mem_per_size', float)])
+
+# ~30 bytes per stitched pixel: the 16 bit slice and a few float copies of it in image_overlay and convert
+default_TV_stitch_mem_cfg = TVStitchMemCfg(base_mem=1, mem_per_size=3e-8)
+
+DeepSegmentMemCfg = NamedTuple("DeepSegmentMemCfg",
+                               [('base_mem', float),
+                                ('mem_per_size', float)])
+
+# ~100 bytes per pixel for the network's activations and masks on top of the model itself (base_mem)
+default_deep_segment_mem_cfg = DeepSegmentMemCfg(base_mem=4, mem_per_size=1e-7)
+
+StacksToVolumeMemCfg = NamedTuple("StacksToVolumeMemCfg",
+                                  [('base_mem', float),
+                                   ('mem_per_voxel', float),
+                                   ('mem_per_size', float)])
+
+# 16 bytes per output voxel (the float64 volume and its conversion when written) and 24 per full resolution
+# pixel (the 16 bit slice, its float64 copy and the filtered intermediate)
+default_stacks_to_volume_mem_cfg = StacksToVolumeMemCfg(base_mem=0.5, mem_per_voxel=1.6e-8, mem_per_size=2.4e-8)
+
+# full resolution pixels stacks_to_volume.py reads at a time with --strip-rows (see process_slice_in_strips)
+STACKS_TO_VOLUME_STRIP_PIXELS = 2 ** 22
+
+def fit_mem_cfg(mem_cfg_type, sizes, peak_mems, headroom: float = 1.2):
+    """
+    Calibrate a memory config from recorded runs by least squares: sizes has one row per run and one column
+    for each size term of mem_cfg_type (everything after base_mem), peak_mems is each run's peak memory in
+    GB. The coefficients are scaled by headroom so that runs like the recorded ones are not killed.
+    """
+    sizes = np.asarray(sizes, dtype=float).reshape((len(peak_mems), -1))
+    design = np.column_stack([np.ones(len(sizes)), sizes])
+    coefficients = np.linalg.lstsq(design, np.asarray(peak_mems, dtype=float), rcond=None)[0]
+    return mem_cfg_type(*[float(c) for c in np.maximum(coefficients, 0) * headroom])
+
+def mosaic_pixels(mosaic: Dict) -> int:
+    """Pixels in one stitched slice of an acquisition, from its Mosaic file (tile sizes default to hi res)."""
+    return int(mosaic["mrows"]) * int(mosaic["mcolumns"]) * \
+           int(mosaic.get("rows", 2080)) * int(mosaic.get("columns", 2080))
 
+def slice_shape(path: str):
+    """The (rows, columns) of a 2D image, read from its header only."""
+    import tifffile
+    with tifffile.TiffFile(path) as tif:
+        return tif.pages[0].shape[:2]
 
 def TV_stitch_wrap(brain_directory: FileAtom,
                    brain_name: str,
@@ -20,23 +72,32 @@ def TV_stitch_wrap(brain_directory: FileAtom,
                    TV_stitch_options,
                    Zstart: int,
                    Zend: int,
-                   output_dir: str):
+                   output_dir: str,
+                   mosaic: Dict = None,
+                   positions: FileAtom = None,
+                   mem_cfg: TVStitchMemCfg = default_TV_stitch_mem_cfg):
 #TODO inputs should be tiles not just brain_directory
+    """
+    Stitch slices Zstart to Zend of a brain. With positions (from TV_stitch_positions) the tiles are placed
+    where that file puts them, on the canvas of the whole brain, so that separately stitched Z ranges line up.
+    """
     stitched = []
     for z in range(Zstart, Zend + 1):
         slice_stitched = FileAtom(os.path.join(slice_directory, brain_name + "_Z%04d.tif" % z))
         stitched.append(slice_stitched)
 
-    stage = CmdStage(inputs=(brain_directory,), outputs=tuple(stitched),
+    stage = CmdStage(inputs=(brain_directory,) + ((positions,) if positions else ()), outputs=tuple(stitched),
                      cmd=['TV_stitch.py', '--clobber',
                           #'--verbose',
                           '--Zstart %s' % Zstart,
                           '--Zend %s' % Zend,
+                          '--use_positions_file %s' % positions.path if positions else
                           '--save_positions_file %s_positions.txt' %
                           os.path.join(stitched[0].dir, brain_name + '_Zstart' + str(Zstart))
                           if TV_stitch_options.save_positions_file else "",
                           '--keeptmp' if TV_stitch_options.keep_tmp else "",
                           '--scaleoutput %s' % TV_stitch_options.scale_output if TV_stitch_options.scale_output else '',
+                          '--projection %s' % TV_stitch_options.projection if TV_stitch_options.projection else '',
                           # '--skip_tile_match' if TV_stitch_options.skip_tile_match else '',
                           # '--Ystart %s' % TV_stitch_options.Ystart if TV_stitch_options.Ystart else '',
                           # '--Yend %s' % TV_stitch_options.Yend if TV_stitch_options.Yend else '',
@@ -58,9 +119,42 @@ def TV_stitch_wrap(brain_directory: FileAtom,
                           os.path.join(brain_directory.path, brain_name),
                           os.path.join(stitched[0].dir, brain_name)],
                      log_file = os.path.join(output_dir, "TV_stitch.log"))
+    # slices are stitched one after the other, so only one is ever in memory
+    if mosaic:
+        stage.setMem(mem_cfg.base_mem + mem_cfg.mem_per_size * mosaic_pixels(mosaic))
 
     return Result(stages=Stages([stage]), output=(stitched))
 
+def TV_stitch_positions(brain_directory: FileAtom,
+                        brain_name: str,
+                        slice_directory: str,
+                        TV_stitch_options,
+                        Zstart: int,
+                        Zend: int,
+                        output_dir: str,
+                        mosaic: Dict = None,
+                        mem_cfg: TVStitchMemCfg = default_TV_stitch_mem_cfg):
+    """
+    Register the tiles of slices Zstart to Zend of a brain and save their positions without stitching, so that
+    the brain can be stitched in several TV_stitch_wrap stages that all place their tiles the same way.
+    """
+    positions = FileAtom(os.path.join(slice_directory, brain_name + "_positions.txt"))
+    stage = CmdStage(inputs=(brain_directory,), outputs=(positions,),
+                     cmd=['TV_stitch.py', '--clobber', '--positions_only',
+                          '--Zstart %s' % Zstart,
+                          '--Zend %s' % Zend,
+                          '--save_positions_file %s' % positions.path,
+                          '--keeptmp' if TV_stitch_options.keep_tmp else "",
+                          '--projection %s' % TV_stitch_options.projection if TV_stitch_options.projection else '',
+                          os.path.join(brain_directory.path, brain_name),
+                          os.path.join(positions.dir, brain_name)],
+                     log_file = os.path.join(output_dir, "TV_stitch.log"))
+    # the tiles are preprocessed just as for stitching, one slice at a time
+    if mosaic:
+        stage.setMem(mem_cfg.base_mem + mem_cfg.mem_per_size * mosaic_pixels(mosaic))
+
+    return Result(stages=Stages([stage]), output=positions)
+
 CellprofilerMemCfg = NamedTuple("CellprofilerMemCfg",
                             [('base_mem', float),
                              ('mem_per_size', float)])
@@ -76,6 +170,7 @@ def deep_segment(image: FileAtom,
                  cell_mean_area: float = None,
                  cell_max_area: int = None,
                  temp_dir: str = None,
+                 mem_cfg: DeepSegmentMemCfg = default_deep_segment_mem_cfg,
                  ):
     anatomical = image.newname_with_suffix("_" + anatomical_suffix)
     count = image.newname_with_suffix("_" + count_suffix)
@@ -89,11 +184,17 @@ def deep_segment(image: FileAtom,
                           '--image %s' % image.path,
                           '--image-output %s' % anatomical.path,
                           '--centroids-output %s' % count.path,
-                          '--outlines-output %s' % outline.path if outline_suffix else ""
+                          '--outlines-output %s' % outline.path if outline_suffix else "",
                           '--cell-min-area %s' % cell_min_area if cell_min_area else "",
                           '--process-clusters --cell-mean-area %s --cell-max-area %s' % (cell_mean_area, cell_max_area)\
                               if (cell_mean_area and cell_max_area) else ""
                           ])
+
+    def set_mem(stage: CmdStage):
+        stage.setMem(mem_cfg.base_mem + mem_cfg.mem_per_size * np.prod(slice_shape(image.path)))
+
+    stage.when_runnable_hooks.append(lambda stage: set_mem(stage))
+
     return Result(stages=Stages([stage]), output=(anatomical, count, outline))
 
 def stacks_to_volume(slices: List[FileAtom],
@@ -101,7 +202,8 @@ def stacks_to_volume(slices: List[FileAtom],
                      z_resolution: float,
                      stacks_to_volume_options,
                      scale_output: float = 1.0,
-                     uniform_sum: bool = False):
+                     uniform_sum: bool = False,
+                     mem_cfg: StacksToVolumeMemCfg = default_stacks_to_volume_mem_cfg):
     stage = CmdStage(inputs=tuple(slices), outputs=(output_volume,),
                      cmd=['stacks_to_volume.py',
                           #TODO these should be part of csv not command line options
@@ -110,9 +212,30 @@ def stacks_to_volume(slices: List[FileAtom],
                           '--slice-gap %s' % z_resolution,
                           '--uniform-sum' if uniform_sum else '',
                           '--scale-output %s' % scale_output,
+                          '--incremental' if stacks_to_volume_options.incremental else '',
+                          '--stream' if stacks_to_volume_options.stream else '',
+                          '--strip-rows %s' % stacks_to_volume_options.strip_rows
+                          if stacks_to_volume_options.strip_rows else '',
+                          '--processes %s' % stacks_to_volume_options.processes,
                           ' '.join(slice.path for slice in slices.__iter__()), #is this hacky or the right way?
                           '%s' % output_volume.path]
                      )
+    stage.setProcs(stacks_to_volume_options.processes)
+
+    def set_mem(stage: CmdStage):
+        # the whole output volume unless it is streamed (as it is when updated incrementally), plus one full
+        # resolution slice, or one strip of it, in each worker
+        shape = np.array(slice_shape(slices[0].path))
+        ratio = stacks_to_volume_options.input_resolution / stacks_to_volume_options.plane_resolution
+        voxels = 0 if stacks_to_volume_options.stream or stacks_to_volume_options.incremental \
+            else len(slices) * np.prod(np.ceil(shape * ratio))
+        pixels = min(np.prod(shape), STACKS_TO_VOLUME_STRIP_PIXELS) if stacks_to_volume_options.strip_rows \
+            else np.prod(shape)
+        stage.setMem(mem_cfg.base_mem + mem_cfg.mem_per_voxel * voxels +
+                     mem_cfg.mem_per_size * pixels * stacks_to_volume_options.processes)
+
+    stage.when_runnable_hooks.append(lambda stage: set_mem(stage))
+
     return Result(stages=Stages([stage]), output=(output_volume))
 
 #refer to the link below for changing these parameters:
@@ -143,6 +266,23 @@ def antsRegistration(fixed: MincAtom,
 
     return Result(stages=Stages([stage]), output=(transform))
 
+def estimate_translation(fixed: MincAtom,
+                         moving: MincAtom,
+                         transform: XfmAtom,
+                         output_dir: str,
+                         shrink_factors: str = "8x4x2x1",
+                         smoothing_sigmas: str = "3x2x1x0"):
+    # drop-in for antsRegistration when only a translation is wanted; transform maps moving onto fixed
+    stage = CmdStage(inputs=(fixed, moving), outputs=(transform,),
+                     cmd = ['estimate_translation.py',
+                            '--shrink-factors %s' % shrink_factors,
+                            '--smoothing-sigmas %s' % smoothing_sigmas,
+                            fixed.path, moving.path, transform.path],
+                     log_file=os.path.join(output_dir, "join_sections.log")
+                     )
+
+    return Result(stages=Stages([stage]), output=(transform))
+
 def antsApplyTransforms(img: FileAtom,
                         transform: XfmAtom,
                         transformed: FileAtom,
@@ -150,16 +290,46 @@ def antsApplyTransforms(img: FileAtom,
                         dimensionality: int = 2):
 
     stage = CmdStage(inputs=(img, transform), outputs=(transformed,),
-                     cmd = ['antsApplyTransform', '--verbose',
+                     cmd = ['antsApplyTransforms', '--verbose',
                             '--dimensionality %s' % dimensionality,
-                            '--input %s' % img,
-                            '--reference-image %s' % img,
-                            '--output %s' % transformed,
-                            '--transform %s' % transform,
+                            '--input %s' % img.path,
+                            '--reference-image %s' % img.path,
+                            '--output %s' % transformed.path,
+                            '--transform %s' % transform.path,
                             ],
                      log_file=os.path.join(output_dir, "join_sections.log"))
     return Result(stages=Stages([stage]), output=(transformed,))
 
+def apply_translations(imgs: List[FileAtom],
+                       transforms: List[XfmAtom],
+                       transformed: List[FileAtom],
+                       output_dir: str,
+                       interpolation: str = "linear",
+                       processes: int = 1):
+    """
+    antsApplyTransforms for many images with translation-only transforms, all in one stage: each image is
+    shifted on its own grid with scipy.ndimage, in a pool of worker processes.
+    """
+    jobs_csv = transformed[0].newname_with_suffix("_translations", ext=".csv")
+    stage = CmdStage(inputs=tuple(imgs) + tuple(transforms), outputs=tuple(transformed),
+                     cmd=['apply_translations.py',
+                          '--interpolation %s' % interpolation,
+                          '--processes %s' % processes,
+                          jobs_csv.path],
+                     log_file=os.path.join(output_dir, "join_sections.log"))
+
+    def write_jobs_csv(stage: CmdStage):
+        os.makedirs(jobs_csv.dir, exist_ok=True)
+        pd.DataFrame({"image": [img.path for img in imgs],
+                      "xfm": [transform.path for transform in transforms],
+                      "output": [output.path for output in transformed]})\
+            .to_csv(jobs_csv.path, index=False)
+
+    stage.when_runnable_hooks.append(lambda stage: write_jobs_csv(stage))
+    stage.setProcs(processes)
+
+    return Result(stages=Stages([stage]), output=tuple(transformed))
+
 def tif_to_minc(tif: FileAtom,
               volume: MincAtom,
               z_resolution: float,
@@ -191,10 +361,10 @@ def get_like(img: MincAtom,
                      log_file=os.path.join(output_dir, "join_sections.log"))
 
     def set_params(stage: CmdStage):
-        img_pyminc = pyminc.volumeFromFile(img.path)
-        ref_pyminc = pyminc.volumeFromFile(ref.path)
-        count = np.maximum(ref_pyminc.data.count, img_pyminc.data.count)
-        sum = ref_pyminc.data.count[0] + img_pyminc.data.count[0]
+        img_header = minc_header(img.path)
+        ref_header = minc_header(ref.path)
+        count = np.maximum(ref_header.sizes, img_header.sizes)
+        sum = ref_header.sizes[0] + img_header.sizes[0]
         for index, arg in enumerate(stage.cmd):
             stage.cmd[index] = arg.format(start = '0,0,0,', count = '%s,%s,%s' % (sum,count[1],count[2]))
 
@@ -211,9 +381,9 @@ def get_through_plane_xfm(img: MincAtom,
                      log_file=os.path.join(output_dir, "join_sections.log"))
 
     def set_params(stage:CmdStage):
-        img_pyminc = pyminc.volumeFromFile(img.path)
-        count = img_pyminc.data.count
-        separations = img_pyminc.data.separations
+        img_header = minc_header(img.path)
+        count = img_header.sizes
+        separations = img_header.separations
         for index, arg in enumerate(stage.cmd):
             stage.cmd[index] = arg.format(y = count[0] * separations[0])
 
@@ -231,6 +401,37 @@ def concat_xfm(xfms: List[XfmAtom],
                      log_file=os.path.join(output_dir, "join_sections.log"))
     return Result(stages=Stages([stage]), output=(outxfm))
 
+def assemble_sections(sections: List[MincAtom],
+                      xfms: List[XfmAtom],
+                      assembled: MincAtom,
+                      output_dir: str,
+                      stack_axis: str = None,
+                      round_offsets: bool = False):
+    """
+    Add sections, in order, into assembled, each moved by the translations composed along the chain of xfms:
+    xfms[i] takes section i onto section i - 1 (None for none) and, with stack_axis, each section is also moved
+    past the one before it along that world axis. This is in place of a get_like/get_through_plane_xfm/
+    concat_xfm/mincmath chain. The sections are handed over in a csv rather than on the command line, however
+    many there are.
+    """
+    sections_csv = assembled.newname_with_suffix("_sections", ext=".csv")
+    stage = CmdStage(inputs=tuple(sections) + tuple(xfm for xfm in xfms if xfm), outputs=(assembled,),
+                     cmd=['assemble_sections.py',
+                          '--stack-axis %s' % stack_axis if stack_axis else '',
+                          '--round' if round_offsets else '',
+                          sections_csv.path, assembled.path],
+                     log_file=os.path.join(output_dir, "join_sections.log"))
+
+    def write_sections_csv(stage: CmdStage):
+        os.makedirs(sections_csv.dir, exist_ok=True)
+        pd.DataFrame({"volume": [section.path for section in sections],
+                      "xfm": [xfm.path if xfm else "" for xfm in xfms]})\
+            .to_csv(sections_csv.path, index=False)
+
+    stage.when_runnable_hooks.append(lambda stage: write_sections_csv(stage))
+
+    return Result(stages=Stages([stage]), output=(assembled))
+
 # this was hacky
 # def mincresample(img: MincAtom,
 #                  xfm: XfmAtom,
@@ -246,6 +447,87 @@ def concat_xfm(xfms: List[XfmAtom],
 #                      log_file = os.path.join(output_dir, "join_sections.log"))
 #     return Result(stages=Stages([stage]), output=resampled)
 
+def resample_batch(imgs: List[MincAtom],
+                   xfm: XfmAtom,
+                   like: MincAtom,
+                   output_dir: str,
+                   interpolations: List[str] = None,
+                   invert: bool = False,
+                   resampled: List[MincAtom] = None):
+    """
+    mincresample -transform xfm -like like for each of imgs in a single stage that evaluates the transform
+    once for all of them. interpolations gives each image's interpolation (nearest, trilinear or tricubic;
+    nearest neighbour images are treated as labels), and resampled the outputs, named after xfm if not given.
+    """
+    interpolations = interpolations or ["trilinear"] * len(imgs)
+    resampled = resampled or [img.newname_with_suffix("_" + xfm.filename_wo_ext + "-resampled") for img in imgs]
+    stage = CmdStage(inputs=tuple(imgs) + (xfm, like), outputs=tuple(resampled),
+                     cmd=['resample_batch.py',
+                          '--transform %s' % xfm.path,
+                          '--like %s' % like.path,
+                          '--invert-transformation' if invert else '',
+                          ' '.join('--image %s %s %s' % (img.path, output.path, interpolation)
+                                   for img, output, interpolation in zip(imgs, resampled, interpolations))],
+                     log_file=os.path.join(output_dir, "resample_batch.log"))
+    return Result(stages=Stages([stage]), output=resampled)
+
+def regional_counts(counts: List[MincAtom],
+                    labels: List[MincAtom],
+                    subjects: List[str],
+                    table: FileAtom,
+                    output_dir: str,
+                    processes: int = 1):
+    """
+    The cell count, volume and density of every label of every subject, as one tidy table: counts[i] is
+    summed over the structures of labels[i], which must be on the same grid.
+    """
+    jobs_csv = table.newname_with_suffix("_jobs")
+    stage = CmdStage(inputs=tuple(counts) + tuple(labels), outputs=(table,),
+                     cmd=['regional_counts.py',
+                          '--processes %s' % processes,
+                          jobs_csv.path, table.path],
+                     log_file=os.path.join(output_dir, "regional_counts.log"))
+
+    def write_jobs_csv(stage: CmdStage):
+        os.makedirs(jobs_csv.dir, exist_ok=True)
+        pd.DataFrame({"subject": subjects,
+                      "count": [count.path for count in counts],
+                      "label": [label.path for label in labels]})\
+            .to_csv(jobs_csv.path, index=False)
+
+    stage.when_runnable_hooks.append(lambda stage: write_jobs_csv(stage))
+    stage.setProcs(processes)
+
+    return Result(stages=Stages([stage]), output=table)
+
+def blur_volumes(imgs: List[MincAtom],
+                 fwhms: List[float],
+                 output_dir: str,
+                 processes: int = 1):
+    """
+    Every image blurred at every FWHM (mm) in one stage, by FFT convolution with one kernel per grid and
+    FWHM. Returns a list of blurred images, named as mincblur would name them, for each FWHM.
+    """
+    blurred = [[img.newname_with_suffix("_fwhm%s_blur" % fwhm) for img in imgs] for fwhm in fwhms]
+    jobs_csv = FileAtom(os.path.join(output_dir, "blur_volumes_jobs.csv"))
+    stage = CmdStage(inputs=tuple(imgs), outputs=tuple(img for imgs_at_fwhm in blurred for img in imgs_at_fwhm),
+                     cmd=['blur_volumes.py',
+                          '--processes %s' % processes,
+                          jobs_csv.path],
+                     log_file=os.path.join(output_dir, "blur_volumes.log"))
+
+    def write_jobs_csv(stage: CmdStage):
+        os.makedirs(jobs_csv.dir, exist_ok=True)
+        pd.DataFrame({"input": [img.path for fwhm in fwhms for img in imgs],
+                      "output": [img.path for imgs_at_fwhm in blurred for img in imgs_at_fwhm],
+                      "fwhm": [fwhm for fwhm in fwhms for img in imgs]})\
+            .to_csv(jobs_csv.path, index=False)
+
+    stage.when_runnable_hooks.append(lambda stage: write_jobs_csv(stage))
+    stage.setProcs(processes)
+
+    return Result(stages=Stages([stage]), output=blurred)
+
 def mincmath(imgs: List[MincAtom],
              result: MincAtom,
              output_dir: str):
@@ -8,6 +8,7 @@ from pydpiper.core.stages import Stages, Result
 from pydpiper.core.arguments import AnnotatedParser, BaseParser, _mk_lsq6_parser, to_lsq6_conf
 from pydpiper.core.util import maybe_deref_path
 from pydpiper.execution.application import mk_application
+from pydpiper.core.files import FileAtom
 from pydpiper.minc.files import MincAtom
 from pydpiper.minc.registration import autocrop, create_quality_control_images, lsq12_nlin, \
     get_linear_configuration_from_options, LinearTransType, get_nonlinear_component, xfmconcat, mincresample_new
@@ -15,6 +16,7 @@ from pydpiper.pipelines.MBM import mbm, mk_mbm_parser
 from pydpiper.pipelines.MAGeT import Interpolation
 
 from core.arguments import consensus_to_atlas_parser
+from core.reconstruction import resample_batch, regional_counts, blur_volumes
 
 def get_imgs(options):
     if options.files:
@@ -73,14 +75,18 @@ def tissue_vision_pipeline(options):
                      mbm_lsq12_nlin_XfmAtom=mbm_result.xfms.lsq12_nlin_xfm.apply(lambda x: x.xfm),
                      mbm_full_XfmAtom=mbm_result.xfms.overall_xfm.apply(lambda x: x.xfm))
 
-    # x.assign(count_lsq6_MincAtom=lambda df: [x + y for x, y in zip(df["x"], df["y"])])
-    csv = csv.assign(count_lsq6_MincAtom = lambda df:
-    [s.defer(mincresample_new(img = img,
-                              xfm = xfm,
-                              like = like))
-     for img, xfm, like in zip(df["count_MincAtom"],
-                               df["mbm_lsq6_XfmAtom"],
-                               df["anatomical_lsq6_MincAtom"])])
+    # with --single-resample-counts the counts go straight from native to atlas space (Step 3),
+    # so their lsq6 resampling is only needed if it was asked for
+    single_resample_counts = options.consensus_to_atlas.single_resample_counts
+    if not single_resample_counts or options.consensus_to_atlas.write_lsq6_counts:
+        # x.assign(count_lsq6_MincAtom=lambda df: [x + y for x, y in zip(df["x"], df["y"])])
+        csv = csv.assign(count_lsq6_MincAtom = lambda df:
+        [s.defer(mincresample_new(img = img,
+                                  xfm = xfm,
+                                  like = like))
+         for img, xfm, like in zip(df["count_MincAtom"],
+                                   df["mbm_lsq6_XfmAtom"],
+                                   df["anatomical_lsq6_MincAtom"])])
 
 
 #############################
@@ -116,22 +122,98 @@ def tissue_vision_pipeline(options):
     csv = csv.assign(lsq6_to_atlas_XfmAtom = lambda df: df['mbm_lsq12_nlin_XfmAtom'].apply(lambda xfm:
                             s.defer(xfmconcat([xfm, lsq12_nlin_result.xfm]))))
 
-    csv = csv.assign(
-        anatomical_targetspace_MincAtom=lambda df:
-        [s.defer(mincresample_new(img=img, xfm=xfm, like=atlas_target))
-         for img, xfm in zip(df["anatomical_lsq6_MincAtom"], df["lsq6_to_atlas_XfmAtom"])],
-        count_targetspace_MincAtom=lambda df:
-        [s.defer(mincresample_new(img=img, xfm=xfm, like=atlas_target))
-         for img, xfm in zip(df["count_lsq6_MincAtom"], df["lsq6_to_atlas_XfmAtom"])],
-        atlas_lsq6space_MincAtom=lambda df:
-        [s.defer(mincresample_new(img=atlas_target_label, xfm=xfm, like=like, invert=True,
-                                  interpolation=Interpolation.nearest_neighbour,
-                                  extra_flags=('-keep_real_range',)))
-         for xfm, like in zip( df["lsq6_to_atlas_XfmAtom"], df["count_lsq6_MincAtom"])]
-    )
+    if single_resample_counts:
+        csv = csv.assign(native_to_atlas_XfmAtom = lambda df:
+                         [s.defer(xfmconcat([lsq6_xfm, atlas_xfm]))
+                          for lsq6_xfm, atlas_xfm in zip(df["mbm_lsq6_XfmAtom"], df["lsq6_to_atlas_XfmAtom"])])
+        counts_to_atlas = zip(csv["count_MincAtom"], csv["native_to_atlas_XfmAtom"])
+    else:
+        counts_to_atlas = zip(csv["count_lsq6_MincAtom"], csv["lsq6_to_atlas_XfmAtom"])
+
+    # the atlas labels are resampled onto anatomical_lsq6_MincAtom, which shares count_lsq6_MincAtom's grid
+    if options.consensus_to_atlas.batch_resample:
+        if single_resample_counts:
+            anatomical_targetspace = [s.defer(resample_batch(imgs=[anatomical], xfm=xfm, like=atlas_target,
+                                                             output_dir=output_dir))[0]
+                                      for anatomical, xfm in zip(csv["anatomical_lsq6_MincAtom"],
+                                                                 csv["lsq6_to_atlas_XfmAtom"])]
+            count_targetspace = [s.defer(resample_batch(imgs=[count], xfm=xfm, like=atlas_target,
+                                                        output_dir=output_dir))[0]
+                                 for count, xfm in counts_to_atlas]
+        else:
+            # anatomical and count share a transform and a grid, so they are resampled together
+            targetspace = [s.defer(resample_batch(imgs=[anatomical, count], xfm=xfm, like=atlas_target,
+                                                  output_dir=output_dir))
+                           for anatomical, (count, xfm) in zip(csv["anatomical_lsq6_MincAtom"], counts_to_atlas)]
+            anatomical_targetspace = [anatomical for anatomical, count in targetspace]
+            count_targetspace = [count for anatomical, count in targetspace]
+        csv = csv.assign(
+            anatomical_targetspace_MincAtom=anatomical_targetspace,
+            count_targetspace_MincAtom=count_targetspace,
+            atlas_lsq6space_MincAtom=lambda df:
+            [s.defer(resample_batch(imgs=[atlas_target_label], xfm=xfm, like=like, output_dir=output_dir,
+                                    interpolations=["nearest"], invert=True,
+                                    # named after the subject, since the atlas label is shared by all of them
+                                    resampled=[like.newname_with_suffix("_" + atlas_target_label.filename_wo_ext)]))[0]
+             for xfm, like in zip(df["lsq6_to_atlas_XfmAtom"], df["anatomical_lsq6_MincAtom"])]
+        )
+    else:
+        csv = csv.assign(
+            anatomical_targetspace_MincAtom=lambda df:
+            [s.defer(mincresample_new(img=img, xfm=xfm, like=atlas_target))
+             for img, xfm in zip(df["anatomical_lsq6_MincAtom"], df["lsq6_to_atlas_XfmAtom"])],
+            count_targetspace_MincAtom=[s.defer(mincresample_new(img=img, xfm=xfm, like=atlas_target))
+                                        for img, xfm in counts_to_atlas],
+            atlas_lsq6space_MincAtom=lambda df:
+            [s.defer(mincresample_new(img=atlas_target_label, xfm=xfm, like=like, invert=True,
+                                      interpolation=Interpolation.nearest_neighbour,
+                                      extra_flags=('-keep_real_range',)))
+             for xfm, like in zip( df["lsq6_to_atlas_XfmAtom"], df["anatomical_lsq6_MincAtom"])]
+        )
+
+    if "count_lsq6_MincAtom" not in csv:
+        # summing counts that were trilinearly resampled to the atlas wouldn't conserve them, so the atlas
+        # labels are brought back to the native counts instead, through the same composed transform
+        if options.consensus_to_atlas.batch_resample:
+            atlas_nativespace = [s.defer(resample_batch(imgs=[atlas_target_label], xfm=xfm, like=count,
+                                                        output_dir=output_dir, interpolations=["nearest"],
+                                                        invert=True,
+                                                        resampled=[count.newname_with_suffix(
+                                                            "_" + atlas_target_label.filename_wo_ext)]))[0]
+                                 for xfm, count in zip(csv["native_to_atlas_XfmAtom"], csv["count_MincAtom"])]
+        else:
+            atlas_nativespace = [s.defer(mincresample_new(img=atlas_target_label, xfm=xfm, like=count, invert=True,
+                                                          interpolation=Interpolation.nearest_neighbour,
+                                                          extra_flags=('-keep_real_range',)))
+                                 for xfm, count in zip(csv["native_to_atlas_XfmAtom"], csv["count_MincAtom"])]
+        csv = csv.assign(atlas_nativespace_MincAtom=atlas_nativespace)
+
+    if options.consensus_to_atlas.count_blur_fwhms:
+        blurred = s.defer(blur_volumes(imgs=csv.count_targetspace_MincAtom.tolist(),
+                                       fwhms=options.consensus_to_atlas.count_blur_fwhms,
+                                       output_dir=output_dir,
+                                       processes=options.consensus_to_atlas.blur_processes))
+        csv = csv.assign(**{"count_targetspace_fwhm%s_MincAtom" % fwhm: imgs
+                            for fwhm, imgs in zip(options.consensus_to_atlas.count_blur_fwhms, blurred)})
 
     csv.applymap(maybe_deref_path).to_csv("analysis.csv",index=False)
 
+#############################
+# Step 4: Count cells in each atlas structure
+#############################
+    if "count_lsq6_MincAtom" in csv:
+        # the counts stay in lsq6 space, where the atlas labels have been resampled onto their grid
+        counts, labels = csv.count_lsq6_MincAtom.tolist(), csv.atlas_lsq6space_MincAtom.tolist()
+    else:
+        # there are no lsq6 counts, so count the native counts themselves, with the atlas labels resampled onto them
+        counts, labels = csv.count_MincAtom.tolist(), csv.atlas_nativespace_MincAtom.tolist()
+    s.defer(regional_counts(counts=counts,
+                            labels=labels,
+                            subjects=csv["count"].tolist(),
+                            table=FileAtom(os.path.join(output_dir, pipeline_name + "_analysis", "regional_counts.csv")),
+                            output_dir=output_dir,
+                            processes=options.consensus_to_atlas.regional_counts_processes))
+
     s.defer(create_quality_control_images(imgs=csv.count_targetspace_MincAtom.tolist(), montage_dir=output_dir,
                                           montage_output=os.path.join(output_dir, pipeline_name + "_resampled",
                                                                       "count_montage"),
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 
+import numpy as np
 import pandas as pd
 
 from pydpiper.core.stages import Stages, Result
@@ -13,76 +14,73 @@ from core.arguments import deep_segment_parser, stacks_to_volume_parser, autocro
 from core.reconstruction import deep_segment, stacks_to_volume
 
 def tv_recon_pipeline(options):
+    slices_df = pd.read_csv(options.application.csv_file,
+                     dtype={"brain_name": str, "brain_directory": str, "slice_directory": str})
+    return minc_recon(slices_df, options)
+
+def minc_recon(slices_df: pd.DataFrame, options):
+    """Segment, stack and resample the stitched slices listed in slices_df (one row per slice, as in TV_slices.csv)."""
     output_dir = options.application.output_directory
     pipeline_name = options.application.pipeline_name
 
     s = Stages()
 
-    slices_df = pd.read_csv(options.application.csv_file,
-                     dtype={"brain_name": str, "brain_directory": str, "slice_directory": str})
-
     if "qc" not in slices_df.columns:
-        slices_df["qc"] = False
         step = int(1 / options.deep_segment.qc_fraction)
-        slices_df.qc[0::step] = True
+        slices_df = slices_df.assign(qc=np.arange(len(slices_df)) % step == 0)
 
 #############################
 # Step 1: Run deep_segment.py
 #############################
-    #TODO surely theres a way around deep_segment_result=""?
-    slices_df = slices_df.assign(
-        deep_segment_result="",
-        segmentation_directory = lambda df: df.apply(
-            lambda row: os.path.join(output_dir, pipeline_name + "_deep_segmentation", row.brain_name), axis=1)
+    # everything below is built with one pass over the slices (and one over the brains), rather than
+    # with row-wise DataFrame operations, so the stage graph of a large cohort is quick to construct
+    slices_df = slices_df.reset_index(drop=True).assign(
+        segmentation_directory = lambda df: df.brain_name.map(
+            lambda brain_name: os.path.join(output_dir, pipeline_name + "_deep_segmentation", brain_name))
     )
-    for index, row in slices_df.iterrows():
-        slices_df.at[index,"deep_segment_result"] = s.defer(deep_segment(image = FileAtom(row.slice,
-                                                                                          output_sub_dir = row.segmentation_directory),
-                                                                         deep_segment_pipeline = FileAtom(options.deep_segment.deep_segment_pipeline),
-                                                                         anatomical_suffix = options.deep_segment.anatomical_name,
-                                                                         count_suffix = options.deep_segment.count_name,
-                                                                         outline_suffix = options.deep_segment.outline_name if row.qc else None,
-                                                                         cell_min_area = options.deep_segment.cell_min_area,
-                                                                         cell_mean_area = options.deep_segment.cell_mean_area,
-                                                                         cell_max_area = options.deep_segment.cell_max_area,
-                                                                         temp_dir = options.deep_segment.temp_dir
-                                                                         ))
-        #hacky solution requires deep_segment() returns in that order
-        #https://stackoverflow.com/questions/35491274/pandas-split-column-of-lists-into-multiple-columns
-        slices_df[["anatomical_result", "count_result", "outline_result"]] = \
-            pd.DataFrame(slices_df.deep_segment_result.values.tolist())
+    deep_segment_pipeline = FileAtom(options.deep_segment.deep_segment_pipeline)
+    images = [FileAtom(slice, output_sub_dir = segmentation_directory)
+              for slice, segmentation_directory in zip(slices_df.slice, slices_df.segmentation_directory)]
+    outline_suffixes = [options.deep_segment.outline_name if qc else None for qc in slices_df.qc]
+    segment_options = dict(deep_segment_pipeline = deep_segment_pipeline,
+                           anatomical_suffix = options.deep_segment.anatomical_name,
+                           count_suffix = options.deep_segment.count_name,
+                           cell_min_area = options.deep_segment.cell_min_area,
+                           cell_mean_area = options.deep_segment.cell_mean_area,
+                           cell_max_area = options.deep_segment.cell_max_area,
+                           temp_dir = options.deep_segment.temp_dir)
+    deep_segment_results = [s.defer(deep_segment(image = image, outline_suffix = outline_suffix, **segment_options))
+                            for image, outline_suffix in zip(images, outline_suffixes)]
+    # requires deep_segment() returns in that order
+    anatomical_results, count_results, outline_results = zip(*deep_segment_results)
+    slices_df = slices_df.assign(anatomical_result = anatomical_results,
+                                 count_result = count_results,
+                                 outline_result = outline_results)
 
 #############################
 # Step 2: Run stacks_to_volume.py
 #############################
-    #This is annoying... If I add anything to slices_df, I will have to delete it here as well
-    mincs_df = slices_df.drop(['slice', 'deep_segment_result', "anatomical_result", "count_result", "outline_result", "qc"], axis=1) \
-        .drop_duplicates().reset_index(drop=True)\
+    # one row per brain, with the slice level columns dropped and the brain's slices gathered in order
+    brains = slices_df.groupby("brain_name", sort=False)
+    mincs_df = slices_df.drop(['slice', "anatomical_result", "count_result", "outline_result", "qc"], axis=1) \
+        .drop_duplicates("brain_name").set_index("brain_name")\
         .assign(
-        anatomical_list = slices_df.groupby("brain_name")['anatomical_result'].apply(list).reset_index(drop=True),
-        count_list=slices_df.groupby("brain_name")['count_result'].apply(list).reset_index(drop=True),
-        #the above is so hacky...
-        stacked_directory=lambda df: df.apply(
-            lambda row: os.path.join(output_dir, pipeline_name + "_stacked", row.brain_name), axis=1),
-    )
-    mincs_df = mincs_df.assign(
-        anatomical_stacked_MincAtom=lambda df: df.apply(
-            lambda row: MincAtom(
-                os.path.join(row.stacked_directory,
-                             row.brain_name + "_" + options.deep_segment.anatomical_name + "_stacked.mnc")
-            ), axis=1
-        ),
-        count_stacked_MincAtom=lambda df: df.apply(
-            lambda row: MincAtom(
-                os.path.join(row.stacked_directory,
-                             row.brain_name + "_" + options.deep_segment.count_name + "_stacked.mnc")
-            ), axis=1
-        )
-    )
+        anatomical_list = brains.anatomical_result.agg(list),
+        count_list = brains.count_result.agg(list),
+    ).reset_index()
+    mincs_df["stacked_directory"] = [os.path.join(output_dir, pipeline_name + "_stacked", brain_name)
+                                     for brain_name in mincs_df.brain_name]
+    mincs_df["anatomical_stacked_MincAtom"] = [
+        MincAtom(os.path.join(stacked_directory, brain_name + "_" + options.deep_segment.anatomical_name + "_stacked.mnc"))
+        for stacked_directory, brain_name in zip(mincs_df.stacked_directory, mincs_df.brain_name)]
+    mincs_df["count_stacked_MincAtom"] = [
+        MincAtom(os.path.join(stacked_directory, brain_name + "_" + options.deep_segment.count_name + "_stacked.mnc"))
+        for stacked_directory, brain_name in zip(mincs_df.stacked_directory, mincs_df.brain_name)]
     if not options.stacks_to_volume.manual_scale_output:
         mincs_df["scale_output"] = mincs_df.interslice_distance/mincs_df.interslice_distance.min()
 
-    for index, row in mincs_df.iterrows():
+    # biggest brains first
+    for index, row in mincs_df.loc[mincs_df.count_list.apply(len).sort_values(ascending=False).index].iterrows():
         s.defer(stacks_to_volume(
             slices = row.anatomical_list,
             output_volume = row.anatomical_stacked_MincAtom,
@@ -101,31 +99,32 @@ def tv_recon_pipeline(options):
 #############################
 # Step 3: Run autocrop to resample to isotropic
 #############################
-    for index, row in mincs_df.iterrows():
-        mincs_df.at[index,"anatomical_isotropic_result"] = s.defer(autocrop(
-            img = row.anatomical_stacked_MincAtom,
+    mincs_df["anatomical_isotropic_result"] = [
+        s.defer(autocrop(
+            img = anatomical_stacked,
             isostep = options.stacks_to_volume.plane_resolution,
             suffix = "isotropic"
-        ))
-        mincs_df.at[index, "count_isotropic_result"] = s.defer(autocrop(
-            img=row.count_stacked_MincAtom,
+        )) for anatomical_stacked in mincs_df.anatomical_stacked_MincAtom]
+    mincs_df["count_isotropic_result"] = [
+        s.defer(autocrop(
+            img=count_stacked,
             isostep=options.stacks_to_volume.plane_resolution,
             suffix="isotropic",
             nearest_neighbour = True
-        ))
+        )) for count_stacked in mincs_df.count_stacked_MincAtom]
 
 #############################
     slices_df = slices_df.assign(
-        anatomical_slice = lambda df: df.apply(lambda row: row.anatomical_result.path, axis=1),
-        count_slice=lambda df: df.apply(lambda row: row.count_result.path, axis=1),
-        outline_slice=lambda df: df.apply(lambda row: row.outline_result.path if row.outline_result else None, axis=1),
+        anatomical_slice = [result.path for result in slices_df.anatomical_result],
+        count_slice = [result.path for result in slices_df.count_result],
+        outline_slice = [result.path if result else None for result in slices_df.outline_result],
     )
     slices_df.drop(slices_df.filter(regex='.*_directory.*|.*_result.*'), axis=1)\
         .to_csv("TV_processed_slices.csv", index=False)
 
     mincs_df = mincs_df.assign(
-        anatomical=lambda df: df.apply(lambda row: row.anatomical_isotropic_result.path, axis=1),
-        count=lambda df: df.apply(lambda row: row.count_isotropic_result.path, axis=1),
+        anatomical = [result.path for result in mincs_df.anatomical_isotropic_result],
+        count = [result.path for result in mincs_df.count_isotropic_result],
     )
     mincs_df.drop(mincs_df.filter(regex='.*_result.*|.*_list.*|.*_MincAtom.*'), axis=1)\
         .to_csv("TV_mincs.csv", index=False)
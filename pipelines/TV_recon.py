@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+from pydpiper.core.stages import Stages, Result
+from pydpiper.execution.application import mk_application
+
+from core.arguments import TV_stitch_parser, deep_segment_parser, stacks_to_volume_parser, autocrop_parser
+from TV_slice_recon import read_brains, stitch_brains, stitched_slices
+from TV_minc_recon import minc_recon
+
+def tv_recon_pipeline(options):
+    """
+    TV_slice_recon.py and TV_minc_recon.py as one pipeline. The stitched slices are real dependencies of the
+    stages that use them, so each slice is segmented as soon as its TV_stitch.py chunk (see --chunk-size) is
+    done, and each brain is stacked as soon as all of its slices are segmented, rather than every brain
+    being stitched before anything else starts.
+    """
+    s = Stages()
+
+    df = s.defer(stitch_brains(read_brains(options), options))
+    df.drop(["mosaic_dictionary", "TV_stitch_result"], axis=1).to_csv("TV_brains.csv", index=False)
+
+    slices_df = stitched_slices(df).reset_index(drop=True)
+    slices_df["mosaic_file"] = slices_df.mosaic_file.astype(str)
+    slices_df.to_csv("TV_slices.csv", index=False)
+
+    s.defer(minc_recon(slices_df, options))
+    return Result(stages=s, output=())
+
+tv_recon_application = mk_application(parsers=[TV_stitch_parser,
+                                               deep_segment_parser,
+                                               stacks_to_volume_parser,
+                                               autocrop_parser],
+                                      pipeline=tv_recon_pipeline)
+
+if __name__ == "__main__":
+    tv_recon_application()
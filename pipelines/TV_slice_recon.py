@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import os, re
-from pathlib import Path; Path.ls = lambda x: list(x.iterdir())
+from pathlib import Path
 from math import isnan
 from typing import  Union, Dict
 
@@ -10,7 +10,7 @@ from pydpiper.core.stages import Stages, Result
 from pydpiper.core.files import FileAtom
 from pydpiper.execution.application import mk_application
 
-from core.reconstruction import TV_stitch_wrap
+from core.reconstruction import TV_stitch_wrap, TV_stitch_positions
 from core.arguments import TV_stitch_parser
 
 def find_mosaic_file(row) -> str:
@@ -24,12 +24,11 @@ def read_mosaic_file(file: str) -> Dict:
     values = re.findall(r"(?<=:).*?(?=\n)", mosaic + "\n")
     return dict(zip(keys, values))
 
-def tv_slice_recon_pipeline(options):
+def read_brains(options) -> pd.DataFrame:
+    """The brains in the csv file, with what their Mosaic files say about them."""
     output_dir = options.application.output_directory
     pipeline_name = options.application.pipeline_name
 
-    s = Stages()
-
     df = pd.read_csv(options.application.csv_file,
                      dtype={"brain_name":str, "brain_directory":str})
     # transforms = (mbm_result.xfms.assign(
@@ -42,26 +41,69 @@ def tv_slice_recon_pipeline(options):
     df["Zstart"] = df.apply(lambda row: 1 if isnan(row.Zstart) else row.Zstart, axis = 1)
     df["Zend"] = df.apply(lambda row: row.number_of_slices - row.Zstart + 1 if isnan(row.Zend) else row.Zend, axis=1)
     df["slice_directory"] = df.apply(lambda row: os.path.join(output_dir, pipeline_name + "_stitched", row.brain_name), axis=1)
+    return df
+
+def stitch_brains(df: pd.DataFrame, options) -> Result:
+    """
+    Run TV_stitch.py on every brain in df, options.TV_stitch.chunk_size slices per stage (the whole brain
+    if not set). A chunked brain's tiles are registered once, by a TV_stitch_positions stage, and every chunk
+    is placed from those positions. The output is df with a TV_stitch_result column holding each brain's list
+    of slices.
+    """
+    output_dir = options.application.output_directory
+
+    s = Stages()
+
+    #TODO surely theres a way around this?
+    df = df.assign(TV_stitch_result = "")
+    # create the biggest brains' stages first so they aren't left running on their own at the end
+    brain_sizes = df.apply(lambda row: int(row.mosaic_dictionary["mrows"]) * int(row.mosaic_dictionary["mcolumns"])
+                                       * (row.Zend - row.Zstart + 1), axis=1)
+    for index, row in df.loc[brain_sizes.sort_values(ascending=False).index].iterrows():
+        Zstart, Zend = int(row.Zstart), int(row.Zend)
+        chunk_size = options.TV_stitch.chunk_size or Zend - Zstart + 1
+        # chunks registered on their own would each pick their own reference slice, offsets and canvas size
+        positions = s.defer(TV_stitch_positions(brain_directory = FileAtom(row.brain_directory),
+                                                brain_name = row.brain_name,
+                                                slice_directory = row.slice_directory,
+                                                TV_stitch_options = options.TV_stitch,
+                                                Zstart = Zstart,
+                                                Zend = Zend,
+                                                output_dir = output_dir,
+                                                mosaic = row.mosaic_dictionary)) \
+            if chunk_size < Zend - Zstart + 1 else None
+        # each chunk's slices can be picked up by later stages as soon as that chunk is stitched
+        df.at[index,"TV_stitch_result"] = [stitched
+                                           for chunk_start in range(Zstart, Zend + 1, chunk_size)
+                                           for stitched in s.defer(TV_stitch_wrap(brain_directory = FileAtom(row.brain_directory),
+                                                                                  brain_name = row.brain_name,
+                                                                                  slice_directory = row.slice_directory,
+                                                                                  TV_stitch_options = options.TV_stitch,
+                                                                                  Zstart=chunk_start,
+                                                                                  Zend=min(chunk_start + chunk_size - 1, Zend),
+                                                                                  output_dir = output_dir,
+                                                                                  mosaic = row.mosaic_dictionary,
+                                                                                  positions = positions
+                                                                                  ))]
+    return Result(stages=s, output=df)
+
+def stitched_slices(df: pd.DataFrame) -> pd.DataFrame:
+    """One row per stitched slice of the brains in df, as written to TV_slices.csv."""
+    return df.explode("TV_stitch_result")\
+        .assign(slice=lambda df: df.apply(lambda row: row.TV_stitch_result.path, axis=1))\
+        .drop(["mosaic_dictionary", "TV_stitch_result"], axis=1)
+
+def tv_slice_recon_pipeline(options):
+    s = Stages()
+
+    df = read_brains(options)
 
 #############################
 # Step 1: Run TV_stitch.py
 #############################
-    #TODO surely theres a way around this?
-    df = df.assign(TV_stitch_result = "")
-    for index, row in df.iterrows():
-        df.at[index,"TV_stitch_result"] = s.defer(TV_stitch_wrap(brain_directory = FileAtom(row.brain_directory),
-                                                                 brain_name = row.brain_name,
-                                                                 slice_directory = row.slice_directory,
-                                                                 TV_stitch_options = options.TV_stitch,
-                                                                 Zstart=row.Zstart,
-                                                                 Zend=row.Zend,
-                                                                 output_dir = output_dir
-                                                                 ))
+    df = s.defer(stitch_brains(df, options))
     df.drop(["mosaic_dictionary", "TV_stitch_result"], axis=1).to_csv("TV_brains.csv", index=False)
-    df.explode("TV_stitch_result")\
-        .assign(slice=lambda df: df.apply(lambda row: row.TV_stitch_result.path, axis=1))\
-        .drop(["mosaic_dictionary", "TV_stitch_result"], axis=1)\
-        .to_csv("TV_slices.csv", index=False)
+    stitched_slices(df).to_csv("TV_slices.csv", index=False)
     return Result(stages=s, output=())
 
 tv_slice_recon_application = mk_application(parsers=[TV_stitch_parser],
@@ -23,12 +23,21 @@ setuptools.setup(
         'tools/TV_stitch.py',
         'tools/stacks_to_volume.py',
         'tools/MIP_first.py',
+        'tools/estimate_translation.py',
+        'tools/assemble_sections.py',
+        'tools/apply_translations.py',
+        'tools/resample_batch.py',
+        'tools/regional_counts.py',
+        'tools/voxel_stats.py',
+        'tools/blur_volumes.py',
         'pipelines/TV_slice_recon.py',
         'pipelines/TV_minc_recon.py',
+        'pipelines/TV_recon.py',
         'pipelines/TVBM.py'
     ],
     install_requires=[
         'fastCell',
         'pydpiper>=2.0.14',
+        'tifffile',
     ]
 )
\ No newline at end of file
@@ -1,70 +1,171 @@
 #!/usr/bin/env python3
 
 import argparse
-import pandas as pd
+import itertools
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import cv2
 import re
-from fastai.vision import Path
-
-parser = argparse.ArgumentParser(description='Perform a maximuim intensity projection on each stack'
-                                             ' of piezo slices for the entire brain')
-parser.add_argument("--input-dir", dest="input_dir", type=str,required=True)
-parser.add_argument("--output-dir", dest="output_dir", type=str, required=True)
-parser.add_argument("--name", dest="name", type=str, required=True)
-args = parser.parse_args()
-
-name = args.name
-input_dir = Path(args.input_dir)
-input_dir_ls = input_dir.ls()
-output_dir = Path(args.output_dir)
-
-slice_dirs = sorted([path for path in input_dir_ls if path.is_dir() and name in path.name])
-tiles = [sorted([path for path in directory.ls() if ".tif" in str(path)],
-               key=lambda tif: int(re.search(r"(?<=-)\d+(?=_)", str(tif)).group(0))) for directory in slice_dirs]
-slice_mosaics = sorted([path for directory in slice_dirs for path in directory.ls() if
-                 ".txt" in path.as_posix() and "Mosaic" in path.as_posix()])
-mosaic = [path for path in input_dir_ls if
-                 ".txt" in str(path) and "Mosaic" in str(path)][0]
-
-values = pd.read_table(mosaic, sep = ":", names = ["parameter", "value"], error_bad_lines=False)
-mrows = int(values[values.parameter=="mrows"].value.item())
-mcolumns = int(values[values.parameter=="mcolumns"].value.item())
-layers = int(values[values.parameter=="layers"].value.item())
-sections = int(values[values.parameter=="sections"].value.item())
-
-# TODO code for checking that things matchup as expected
-# slice_dirs = [top_dir/(name + "-" +'{:04d}'.format(i))  for i in range(1,sections+1)]
-
-output_slice_dirs = [output_dir/name/slice_dir.name for slice_dir in slice_dirs]
-output_slice_mosaics = [output_slice_dir/slice_mosaic.name for
-                       output_slice_dir, slice_mosaic in zip(output_slice_dirs, slice_mosaics)]
-
-N = mrows * mcolumns
-mip = [[output_slice_dirs[i]/tiles[i][j].name for j in range(N)] for i in range(sections)]
-
-(output_dir/name).mkdir(parents=True, exist_ok=True)
-pd.read_table(mosaic.as_posix(), header=None, squeeze=True)\
-    .str.replace("Zscan:1", "Zscan:0").str.replace("layers:5", "layers:1")\
-    .to_csv(output_dir/name/mosaic.name, header=False, index=False)
-
-for i in range(sections):
-    print("Currently working on the tiles in " + output_slice_dirs[i].as_posix() + ".")
-    output_slice_dirs[i].mkdir(parents=True, exist_ok=True)
-
-# TODO dynamically reduce any number of piezo slices
-    (pd.read_table(slice_mosaics[i].as_posix(), header=None, squeeze=True)
+from pathlib import Path
+
+PROJECTIONS = ["max", "mean", "sum"]
+
+def read_mosaic_values(mosaic):
+    import pandas as pd  # only the mosaic files need it, not the tile projections TV_stitch.py imports from here
+    values = pd.read_table(mosaic, sep = ":", names = ["parameter", "value"], error_bad_lines=False)
+    return {parameter: values[values.parameter==parameter].value.item()
+            for parameter in ["mrows", "mcolumns", "layers", "sections", "Zscan"]}
+
+def rewrite_mosaic(mosaic, output_mosaic):
+    import pandas as pd
+    # the projected acquisition has a single layer per tile position
+    (pd.read_table(Path(mosaic).as_posix(), header=None, squeeze=True)
      .str.replace("Zscan:1", "Zscan:0")
-     .str.replace("layers:5", "layers:1")
-     .to_csv(output_slice_mosaics[i].as_posix(), header=False, index=False))
-
-
-    for j in range(N):
-        img = np.maximum.reduce([
-            cv2.imread(tiles[i][j + 0 * N].as_posix(), cv2.COLOR_BGR2GRAY),
-            cv2.imread(tiles[i][j + 1 * N].as_posix(), cv2.COLOR_BGR2GRAY),
-            cv2.imread(tiles[i][j + 2 * N].as_posix(), cv2.COLOR_BGR2GRAY),
-            cv2.imread(tiles[i][j + 3 * N].as_posix(), cv2.COLOR_BGR2GRAY),
-            cv2.imread(tiles[i][j + 4 * N].as_posix(), cv2.COLOR_BGR2GRAY),
-        ])
-        cv2.imwrite(mip[i][j].as_posix(), img)
\ No newline at end of file
+     .str.replace(r"^layers:\d+", "layers:1", regex=True)
+     .to_csv(Path(output_mosaic).as_posix(), header=False, index=False))
+
+def read_layers(layer_paths, reader, prefetch):
+    """
+    Yield the raw contents of the layers in order, reading at most `prefetch` layers ahead on the reader
+    pool; decoding is left to whoever projects the tile.
+    """
+    layer_paths = iter(layer_paths)
+    reads = deque(reader.submit(np.fromfile, str(layer_path), dtype=np.uint8)
+                  for layer_path in itertools.islice(layer_paths, prefetch))
+    while reads:
+        layer = reads.popleft().result()
+        layer_path = next(layer_paths, None)
+        if layer_path is not None:
+            reads.append(reader.submit(np.fromfile, str(layer_path), dtype=np.uint8))
+        yield layer
+
+def decode_layer(layer):
+    if isinstance(layer, np.ndarray):
+        return cv2.imdecode(layer, cv2.COLOR_BGR2GRAY)
+    return cv2.imread(str(layer), cv2.COLOR_BGR2GRAY)
+
+def project_tile(layers, output_path, projection="max"):
+    """
+    Project the piezo layers of a single tile position into one image. The layers (paths, or encoded file
+    contents streamed by read_layers) are decoded one at a time and accumulated in place, so at most one
+    decoded layer and the accumulator are held in memory.
+    """
+    accumulator = None
+    count = 0
+    for count, layer in enumerate(layers, 1):
+        layer = decode_layer(layer)
+        if accumulator is None:
+            dtype = layer.dtype
+            # sums (and the sums behind means) need headroom beyond the tile's own type
+            accumulator = layer if projection == "max" else layer.astype(np.promote_types(dtype, np.uint32))
+        elif projection == "max":
+            np.maximum(accumulator, layer, out=accumulator)
+        else:
+            np.add(accumulator, layer, out=accumulator)
+    if projection == "mean":
+        if np.issubdtype(accumulator.dtype, np.integer):
+            accumulator += count // 2
+            accumulator //= count
+        else:
+            accumulator /= count
+    # a mean fits back in the tile's type, but a sum doesn't, so sums are written as float32 TIFFs (exact
+    # up to 2**24, far beyond any stack of 16 bit layers)
+    cv2.imwrite(str(output_path), accumulator.astype(np.float32 if projection == "sum" else dtype, copy=False))
+
+def project_tiles(jobs, projection="max", workers=1, pool="thread", prefetch=2, report_every=100):
+    """
+    Project every (layer_paths, output_path) job, up to `workers` tiles at a time. In a thread pool each tile's
+    layers are streamed to it with up to `prefetch` of them read ahead on a pool of I/O threads, so neither
+    the storage nor the CPUs sit idle waiting on the other while at most workers * prefetch encoded layers
+    are held in memory. Worker processes can't share the readers and read their own layers instead.
+    """
+    jobs = list(jobs)
+    projections = deque()
+    projector_pool = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers * prefetch) as reader, \
+            projector_pool(max_workers=workers) as projector:
+        def collect():
+            nonlocal done
+            projections.popleft().result()
+            done += 1
+            if done % report_every == 0 or done == len(jobs):
+                print("Projected %d of %d tiles (%.1f tiles/s)" % (done, len(jobs), done / (time.time() - start)))
+
+        done = 0
+        for layer_paths, output_path in jobs:
+            if len(projections) == workers:
+                collect()
+            layers = layer_paths if pool == "process" else read_layers(layer_paths, reader, prefetch)
+            projections.append(projector.submit(project_tile, layers, output_path, projection))
+        while projections:
+            collect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Perform an intensity projection on each stack'
+                                                 ' of piezo slices for the entire brain')
+    parser.add_argument("--input-dir", dest="input_dir", type=str,required=True)
+    parser.add_argument("--output-dir", dest="output_dir", type=str, required=True)
+    parser.add_argument("--name", dest="name", type=str, required=True)
+    parser.add_argument("--projection", dest="projection", choices=PROJECTIONS, default="max",
+                        help="How to combine the piezo layers of each tile; sums are written as float32 "
+                             "TIFFs, since they outgrow the tiles' type, and can't be stitched by TV_stitch.py "
+                             "(use mean for that) [default = %(default)s]")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Number of tiles to project concurrently [default = %(default)s]")
+    parser.add_argument("--pool", dest="pool", choices=["thread", "process"], default="thread",
+                        help="Project tiles in a pool of threads (cv2 releases the GIL) or of processes "
+                             "[default = %(default)s]")
+    parser.add_argument("--prefetch", dest="prefetch", type=int, default=2,
+                        help="Number of layers each thread pool worker reads ahead of the one it's projecting "
+                             "[default = %(default)s]")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.prefetch < 1:
+        parser.error("--prefetch must be at least 1")
+
+    name = args.name
+    input_dir = Path(args.input_dir)
+    input_dir_ls = list(input_dir.iterdir())
+    output_dir = Path(args.output_dir)
+
+    slice_dirs = sorted([path for path in input_dir_ls if path.is_dir() and name in path.name])
+    tiles = [sorted([path for path in directory.iterdir() if ".tif" in str(path)],
+                   key=lambda tif: int(re.search(r"(?<=-)\d+(?=_)", str(tif)).group(0))) for directory in slice_dirs]
+    slice_mosaics = sorted([path for directory in slice_dirs for path in directory.iterdir() if
+                     ".txt" in path.as_posix() and "Mosaic" in path.as_posix()])
+    mosaic = [path for path in input_dir_ls if
+                     ".txt" in str(path) and "Mosaic" in str(path)][0]
+
+    values = read_mosaic_values(mosaic)
+    mrows = int(values["mrows"])
+    mcolumns = int(values["mcolumns"])
+    # without a Z scan there is only ever one layer, whatever the layers entry says
+    layers = int(values["layers"]) if int(values["Zscan"]) else 1
+    sections = int(values["sections"])
+
+    # TODO code for checking that things matchup as expected
+    # slice_dirs = [top_dir/(name + "-" +'{:04d}'.format(i))  for i in range(1,sections+1)]
+
+    output_slice_dirs = [output_dir/name/slice_dir.name for slice_dir in slice_dirs]
+    output_slice_mosaics = [output_slice_dir/slice_mosaic.name for
+                           output_slice_dir, slice_mosaic in zip(output_slice_dirs, slice_mosaics)]
+
+    N = mrows * mcolumns
+    mip = [[output_slice_dirs[i]/tiles[i][j].name for j in range(N)] for i in range(sections)]
+
+    (output_dir/name).mkdir(parents=True, exist_ok=True)
+    rewrite_mosaic(mosaic, output_dir/name/mosaic.name)
+
+    for i in range(sections):
+        output_slice_dirs[i].mkdir(parents=True, exist_ok=True)
+        rewrite_mosaic(slice_mosaics[i], output_slice_mosaics[i])
+
+    # tiles are stored plane-wise: layer k of tile position j is tile j + k*N
+    project_tiles([([tiles[i][j + k * N] for k in range(layers)], mip[i][j])
+                   for i in range(sections) for j in range(N)],
+                  projection=args.projection, workers=args.workers, pool=args.pool, prefetch=args.prefetch,
+                  report_every=N)
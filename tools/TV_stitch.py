@@ -13,17 +13,16 @@ import subprocess
 import getopt
 import argparse
 import re
-from numpy import *
+from numpy import arange, array, dot, empty, exp, identity, isnan, less, log, maximum, mean, median, minimum, \
+    nan, nonzero, ones, sqrt, std, unique, where, zeros
 from numpy.linalg import lstsq
 import glob
 import operator
-from fastai.vision import Path
+from pathlib import Path
 
 #TODO why is this even needed? it breaks importing from TV_stitch
 #from tissue_vision.Zstack_icorr import *
 
-from scipy.stats import t
-
 program_name = 'TV_stitch.py'
 
 #CURRENTLY TOGGLES BETWEEN ONLY A LO AND A HI RES MODE
@@ -214,7 +213,7 @@ def run_cvFilter(infile,outfile,kernelstr="gauss",kernelwidth=9,filtwidth=1.4):
 
 def generate_preprocessed_images(inputdirectory,starts=[None,None,None],ends=[None,None,None],channelflag=1,\
                                  imgftype='tif',fastpiezoloop=False,gradcombine=False,im=False,
-                                 corr_tile_nonuniformity=False,medfilter_tile=False,medfilter_size=3):
+                                 corr_tile_nonuniformity=False,medfilter_tile=False,medfilter_size=3,projection=None):
     #find and compose list of directories to work with
     try:
         fulldirectorylist = glob.glob(inputdirectory+'-[0-9]*')
@@ -270,6 +269,24 @@ def generate_preprocessed_images(inputdirectory,starts=[None,None,None],ends=[No
             print("**************************************************************************")
             nfiles = min([nfiles,N_z_piezo*TVparamdict['posarray'].shape[0]])
         globlist=globlist[0:nfiles] #this line here only because sometimes TV errors generate extra files
+        if (projection!=None) and (N_z_piezo>1):
+            #collapse the piezo layers of each tile position on the fly instead of stitching each layer
+            from MIP_first import project_tile
+            #sections outside the Z range only need their Tile records, not their projections
+            in_zrange = ((starts[0]==None) or (j+1>=starts[0])) and ((ends[0]==None) or (j+1<=ends[0]))
+            for posindex in range(nfiles//N_z_piezo):
+                if (fastpiezoloop):
+                    layerfiles = globlist[posindex*N_z_piezo:(posindex+1)*N_z_piezo]
+                else:
+                    layerfiles = globlist[posindex:nfiles:N_x*N_y]
+                cfile = gen_tempfile('Tile_%s_Z%03d_P%04d'%(projection,j+1,posindex),imgftype)
+                if (in_zrange) and not (os.path.exists(cfile)):
+                    project_tile(layerfiles,cfile,projection=projection)
+                reported_zpos = 0.001*TVparamdict['sectionres']*j
+                reported_xpos = TVparamdict['posarray'][posindex,1]
+                reported_ypos = TVparamdict['posarray'][posindex,0]*-1.0
+                TileList.append( Tile(cfile,None,None,None,[j+1,0,0],[reported_zpos,reported_ypos,reported_xpos]) )
+            continue
         for k in range(nfiles):
             cfile = globlist[k]
             if (fastpiezoloop):
@@ -350,7 +367,7 @@ def generate_preprocessed_images(inputdirectory,starts=[None,None,None],ends=[No
         TileList[j].pixoffsetarray[0] = TileList[j].indexarray[0]
     #delete TileList elements with images that were not cropped
     TileList = [ctile for ctile in TileList if ctile.croppedfilename!=None]
-    TVparamdict['N_z_piezo'] = N_z_piezo
+    TVparamdict['N_z_piezo'] = [N_z_piezo,1][projection!=None]
     return TileList,TVparamdict
 
 def weighted_linear_least_squares(Amat,bcol,w):
@@ -499,6 +516,7 @@ def compute_offsets(TileList,overlapx=20.0,overlapy=15.0,Zref=-1,Cthresh=0.3,zse
                             for di,zi in zip(direclist,zposlist)],float)
             Bstd = array([stdij[di] for di in direclist],float)
             Bdf = array([dfij[di] for di in direclist],float)
+            from scipy.stats import t  # slow to import, and only needed for the outlier weights
             wdist = 2.0*(1.0-t.cdf(abs(Barray - Bideal)/Bstd,Bdf))
             wdist = where(isnan(wdist),1.0,wdist)
             warray = warray * wdist
@@ -595,7 +613,8 @@ def get_positions_from_file(TileList,positions_file):
             ctile.pixoffsetarray = array(positions[matching_index],float)
         else:
             print("Failed to find matching coordinate indices for %s"%ctile.filename)
-    return 0
+    #the file can cover more slices than TileList, so all of its positions are returned too
+    return array(positions,float)
 
 def generate_mnc_file_from_tifstack(Zstacklist,outputfile,zstep=0.01,ystep=TV_LORES,xstep=TV_LORES,outdatatype="byte",Zcoordlist=None):
     outputprefix=outputfile[:-4]
@@ -653,6 +672,9 @@ if __name__ == '__main__':
                       help="use an existing positions file instead of generating positions from the input")
     parser.add_argument("--save_positions_file", type=str, dest="save_positions_file", metavar="positions_file.txt", \
                       help="save the final positions to file (for subsequent use with use_positions_file)")
+    parser.add_argument("--positions_only", action="store_true", dest="positions_only",
+                       default=False, help="only determine the tile positions and save them with save_positions_file, "
+                                           "so that Z ranges of one brain can be stitched separately from them")
     parser.add_argument("--overlapx",type=float,dest="overlapx",default=20.0,
                       help="tile overlap in percent")
     parser.add_argument("--overlapy",type=float,dest="overlapy",default=20.0,
@@ -677,6 +699,11 @@ if __name__ == '__main__':
                        default=0, help="intensity normalize piezo stacked images")
     parser.add_argument("--fastpiezo", action="store_true", dest="fastpiezo",
                        default=0, help="piezo stack tiles are stored consecutively (instead of plane-wise)")
+    parser.add_argument("--projection", type=str, dest="projection", choices=["max","mean"],
+                       default=None, help="project the piezo stack of each tile position into a single plane "
+                                          "before stitching (instead of stitching each piezo plane); sums aren't "
+                                          "offered since they outgrow the tiles' type, which crop_img and "
+                                          "image_overlay keep")
     #parser.add_argument("--Ydown", action="store_true", dest="Ydown",
     #                   default=0, help="first pass is moving down (default is up)")
     parser.add_argument("--short", action="store_const", const="short", dest="output_datatype",
@@ -711,6 +738,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     VERBOSE = args.verbose
+    if (args.positions_only) and not (args.save_positions_file):
+        parser.error("--positions_only needs --save_positions_file")
 
     if (args.use_temp!=None):
         TEMPDIRECTORY=args.use_temp
@@ -729,7 +758,8 @@ if __name__ == '__main__':
                                                         channelflag=args.channel,imgftype=args.TV_file_type,\
                                                         fastpiezoloop=args.fastpiezo,gradcombine=args.gradimag,\
                                                         im=args.im,corr_tile_nonuniformity=args.corr_tile_nonuniformity,
-                                                        medfilter_tile=args.medfilter_tile,medfilter_size=args.medfilter_size)
+                                                        medfilter_tile=args.medfilter_tile,medfilter_size=args.medfilter_size,
+                                                        projection=args.projection)
     uniqueZ=unique([ctile.indexarray[0] for ctile in TileList])
 
     #determine offsets with CCimages or read in positions from previously written file (or place images directly on a grid)
@@ -746,19 +776,29 @@ if __name__ == '__main__':
         if getattr(args,'save_positions_file'):
             save_positions_to_file(TileList,args.save_positions_file)
     else:
-        get_positions_from_file(TileList,args.use_positions_file)
+        file_positions = get_positions_from_file(TileList,args.use_positions_file)
+
+    if (args.positions_only):
+        if (not args.keeptmp) and (args.use_temp==None):
+            cmdout = run_subprocess("rm -r %s"%TEMPDIRECTORY)
+        raise SystemExit
 
     #adjust positions to be all positive offsets based on global minima
+    #(a positions file covers the whole brain, so every Z range stitched from it is placed on the same canvas)
     cmdout=run_subprocess("identify -format \"%%w %%h\" %s"%TileList[0].croppedfilename)
     matX=int(cmdout.split()[0]); matY=int(cmdout.split()[1])
-    min_offset_x = min([ctile.pixoffsetarray[2] for ctile in TileList])
-    min_offset_y = min([ctile.pixoffsetarray[1] for ctile in TileList])
+    if (existing_positions_file_flag) and not (args.skip_tile_match):
+        all_positions = file_positions
+    else:
+        all_positions = array([ctile.pixoffsetarray for ctile in TileList],float)
+    min_offset_x = minimum.reduce(all_positions[:,2])
+    min_offset_y = minimum.reduce(all_positions[:,1])
     for ctile in TileList:
         ctile.pixoffsetarray[2] -= min_offset_x
         ctile.pixoffsetarray[1] -= min_offset_y
-    max_offset_x = max([ctile.pixoffsetarray[2] for ctile in TileList])
+    max_offset_x = maximum.reduce(all_positions[:,2]) - min_offset_x
     outimg_size_x = max_offset_x + matX
-    max_offset_y = max([ctile.pixoffsetarray[1] for ctile in TileList])
+    max_offset_y = maximum.reduce(all_positions[:,1]) - min_offset_y
     outimg_size_y = max_offset_y + matY
 
     #overlay images with opencv based run_image_overlay     
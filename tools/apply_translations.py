@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import functools
+
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+
+from estimate_translation import WORLD_AXES, read_translation_xfm
+
+INTERPOLATION_ORDERS = {"nearest": 0, "linear": 1, "cubic": 3}
+
+def shift_array(a, shift, order=1):
+    """
+    a with its contents moved by shift voxels (output[i] = a[i - shift]), zero filled. Whole voxel shifts
+    are plain copies; the others are interpolated with a spline of the given order.
+    """
+    if np.allclose(shift, np.round(shift)):
+        shift = np.round(shift).astype(int)
+        shifted = np.zeros_like(a)
+        source = tuple(slice(max(0, -s), n - max(0, s)) for s, n in zip(shift, a.shape))
+        target = tuple(slice(max(0, s), n - max(0, -s)) for s, n in zip(shift, a.shape))
+        shifted[target] = a[source]
+        return shifted
+    return scipy.ndimage.shift(a, shift, order=order, mode="constant", cval=0)
+
+def apply_translation(job, order=1):
+    """
+    Resample one image, on its own grid, by the translation in an MNI .xfm (mapping it onto the output).
+    MINC volumes are shifted in world units; other images (read with tifffile) in pixels, x along the
+    columns and y down the rows, as antsApplyTransforms treats images without a spacing.
+    """
+    image, xfm, output = job
+    translation = read_translation_xfm(xfm)
+    if image.endswith(".mnc"):
+        vol = volumeFromFile(image)
+        shift = [translation[WORLD_AXES.index(dimname)] / separation
+                 for dimname, separation in zip(vol.dimnames, vol.separations)]
+        shifted = shift_array(np.asarray(vol.data), shift, order)
+        vol.closeVolume()
+        out = volumeLikeFile(image, output)
+        out.data[...] = shifted
+        out.writeFile()
+        out.closeVolume()
+    else:
+        import tifffile
+        a = tifffile.imread(image)
+        shifted = shift_array(a.astype(float), [translation[1], translation[0]] + [0] * (a.ndim - 2), order)
+        if np.issubdtype(a.dtype, np.integer):
+            shifted = np.clip(np.round(shifted), np.iinfo(a.dtype).min, np.iinfo(a.dtype).max)
+        tifffile.imwrite(output, shifted.astype(a.dtype))
+    return output
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply translation-only .xfm transforms to many images at once, "
+                                                 "each resampled on its own grid, in a pool of worker processes.")
+    parser.add_argument("jobs_csv", type=str,
+                        help="csv with image, xfm and output columns, one row per image")
+    parser.add_argument("--interpolation", dest="interpolation", choices=list(INTERPOLATION_ORDERS),
+                        default="linear", help="Interpolation for sub-voxel shifts [default = %(default)s]")
+    parser.add_argument("--processes", dest="processes", type=int, default=1,
+                        help="Number of images to resample in parallel [default = %(default)s]")
+    args = parser.parse_args()
+
+    jobs = list(pd.read_csv(args.jobs_csv, dtype=str)[["image", "xfm", "output"]].itertuples(index=False, name=None))
+    apply = functools.partial(apply_translation, order=INTERPOLATION_ORDERS[args.interpolation])
+    # workers each read, shift and write whole images; nothing comes back but the output name
+    pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+    for i, output in enumerate(pool.imap_unordered(apply, jobs) if pool else map(apply, jobs)):
+        print("Wrote %s (%d of %d)" % (output, i + 1, len(jobs)))
+    if pool:
+        pool.close()
+        pool.join()
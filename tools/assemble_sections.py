@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from pyminc.volumes.factory import volumeFromFile, volumeFromDescription
+import numpy as np
+import pandas as pd
+
+from core.minc_header import minc_header
+from estimate_translation import WORLD_AXES, read_translation_xfm
+
+def compose_translations(headers, pairwise, stack_axis=None):
+    """
+    The translation (x, y, z) of each section onto the assembled volume. pairwise[i] takes section i onto
+    section i - 1 (as estimate_translation.py writes it, with fixed = section i - 1), so the translations
+    add up along the chain; xfmconcat of translations is just their sum. With stack_axis, each section is
+    also moved past the one before it by that section's extent along stack_axis, as the param2xfm through
+    plane transforms did.
+    """
+    translations = []
+    total = np.zeros(3)
+    for i, ((dimnames, sizes, starts, separations), translation) in enumerate(zip(headers, pairwise)):
+        if i > 0:
+            total = total + translation
+            if stack_axis:
+                previous_dimnames, previous_sizes, _, previous_separations = headers[i - 1]
+                axis = previous_dimnames.index(stack_axis)
+                total[WORLD_AXES.index(stack_axis)] += previous_sizes[axis] * previous_separations[axis]
+        translations.append(total)
+    return translations
+
+def section_offsets(headers, translations, round_offsets=False):
+    """
+    The offset of each section in the assembled volume, in voxels of the first section's grid (fractional
+    unless round_offsets), along with the assembled volume's size and starts. A fractional offset spreads a
+    section over one more voxel along that axis.
+    """
+    dimnames, sizes, starts, separations = headers[0]
+    offsets = []
+    for (section_dimnames, section_sizes, section_starts, section_separations), translation \
+            in zip(headers, translations):
+        if section_dimnames != dimnames or not np.allclose(section_separations, separations):
+            raise ValueError("all sections need the same dimension order and separations")
+        # translation is in x, y, z; the starts are in the volumes' dimension order
+        shift = np.array([translation[WORLD_AXES.index(dimname)] for dimname in dimnames])
+        offset = (section_starts + shift - starts) / separations
+        offsets.append(np.round(offset) if round_offsets else offset)
+    offsets = np.array(offsets)
+    origin = np.floor(offsets).min(axis=0).astype(int)
+    size = (np.ceil(offsets) + np.array([header[1] for header in headers])).max(axis=0).astype(int) - origin
+    return offsets - origin, size, starts + origin * separations
+
+def shift_axis(a, axis, offset, start, count):
+    """
+    Output voxels start to start + count - 1 along axis of a moved by offset voxels, linearly interpolated
+    between neighbouring voxels of a and zero outside it (as mincresample fills).
+    """
+    n = a.shape[axis]
+    padded = np.pad(a, [(1, 1) if i == axis else (0, 0) for i in range(a.ndim)])
+    coords = np.arange(start, start + count) - offset
+    low = np.floor(coords).astype(int)
+    weight = (coords - low).reshape([-1 if i == axis else 1 for i in range(a.ndim)])
+    below = padded.take(np.clip(low + 1, 0, n + 1), axis)
+    if not weight.any():
+        return below
+    return below * (1 - weight) + padded.take(np.clip(low + 2, 0, n + 1), axis) * weight
+
+def section_ranges(volumes, slab_voxels=2 ** 24):
+    """The smallest and largest real value of each of volumes, read a slab at a time."""
+    ranges = []
+    for volume in volumes:
+        sizes = minc_header(volume).sizes
+        slab = max(1, slab_voxels // int(np.prod(sizes[1:])))
+        section = volumeFromFile(volume)
+        low, high = 0.0, 0.0
+        for start in range(0, sizes[0], slab):
+            count = (min(slab, sizes[0] - start),) + tuple(sizes[1:])
+            data = np.asarray(section.getHyperslab((start,) + (0,) * (len(sizes) - 1), count))
+            low, high = min(low, float(data.min())), max(high, float(data.max()))
+        section.closeVolume()
+        ranges.append((low, high))
+    return np.array(ranges)
+
+def assemble_sections(volumes, pairwise_xfms, output, volume_type="ushort", stack_axis=None,
+                      round_offsets=False, slab_voxels=2 ** 24):
+    """
+    Add each of volumes, moved by its translation composed along the chain of pairwise_xfms (None for
+    none), into a single output volume. The output is produced and written a slab of its first dimension at
+    a time, so only that slab and the matching slabs of the sections it overlaps are ever in memory.
+    """
+    headers = [minc_header(volume) for volume in volumes]
+    pairwise = [read_translation_xfm(xfm) if xfm else np.zeros(3) for xfm in pairwise_xfms]
+    offsets, size, starts = section_offsets(headers, compose_translations(headers, pairwise, stack_axis),
+                                            round_offsets)
+    dimnames, _, _, separations = headers[0]
+    section_sizes = np.array([header.sizes for header in headers])
+    # the first and last output voxel of each section along the first dimension
+    first = np.floor(offsets[:, 0]).astype(int)
+    last = np.ceil(offsets[:, 0]).astype(int) + section_sizes[:, 0] - 1
+
+    # the real range has to be set before any slab is written: overlapping sections add up, and
+    # interpolation never goes beyond the values interpolated
+    ranges = section_ranges(volumes, slab_voxels)
+    coverage = np.zeros((size[0], 2))
+    for (low, high), a, b in zip(ranges, first, last):
+        coverage[a:b + 1] += (low, high)
+    assembled = volumeFromDescription(output, dimnames, sizes=tuple(size), starts=tuple(starts),
+                                      steps=tuple(separations), volumeType=volume_type)
+    assembled.setVolumeRanges(np.array([coverage[:, 0].min(), max(coverage[:, 1].max(), 1e-6)]))
+
+    sections = [volumeFromFile(volume) for volume in volumes]
+    slab = max(1, slab_voxels // int(np.prod(size[1:])))
+    for start in range(0, size[0], slab):
+        count = min(slab, size[0] - start)
+        assembled_slab = np.zeros((count,) + tuple(size[1:]), dtype=np.float32)
+        for i in np.flatnonzero((first < start + count) & (last >= start)):
+            # the section's voxels along the first dimension that land in this slab (and one beyond)
+            low = max(0, int(np.floor(start - offsets[i, 0])))
+            high = min(section_sizes[i, 0], int(np.floor(start + count - 1 - offsets[i, 0])) + 2)
+            data = np.asarray(sections[i].getHyperslab((low,) + (0,) * (len(size) - 1),
+                                                       (high - low,) + tuple(section_sizes[i, 1:])),
+                              dtype=np.float32)
+            data = shift_axis(data, 0, offsets[i, 0] + low, start, count)
+            for axis in range(1, len(size)):
+                data = shift_axis(data, axis, offsets[i, axis], 0, size[axis])
+            assembled_slab += data
+        print("Writing voxels %d to %d of %d" % (start, start + count, size[0]))
+        assembled.setHyperslab(assembled_slab, start=(start,) + (0,) * (len(size) - 1),
+                               count=assembled_slab.shape)
+    for section in sections:
+        section.closeVolume()
+    assembled.closeVolume()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assemble section volumes into one volume, each moved by the "
+                                                 "translations composed along its chain of pairwise xfms and "
+                                                 "added in, as a mincreshape/param2xfm/xfmconcat/mincresample/"
+                                                 "mincmath -add chain would.")
+    parser.add_argument("sections_csv", type=str,
+                        help="csv with a volume column, in order, and an optional xfm column giving the "
+                             "translation of each section onto the one before it (empty for none)")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--volume-type", dest="volume_type", type=str, default="ushort",
+                        help="Storage type of the output [default = %(default)s]")
+    parser.add_argument("--stack-axis", dest="stack_axis", choices=WORLD_AXES, default=None,
+                        help="Also move each section past the one before it by that section's extent along "
+                             "this axis, as the param2xfm through plane transforms did [default = %(default)s]")
+    parser.add_argument("--round", dest="round_offsets", action="store_true", default=False,
+                        help="Round each section's offset to whole voxels and copy its voxels as they are, "
+                             "instead of linearly interpolating sub-voxel shifts")
+    parser.add_argument("--slab-voxels", dest="slab_voxels", type=int, default=2 ** 24,
+                        help="Output voxels to assemble and write at a time [default = %(default)s]")
+    args = parser.parse_args()
+
+    sections = pd.read_csv(args.sections_csv, dtype=str, keep_default_na=False)
+    assemble_sections(list(sections.volume),
+                      list(sections.xfm) if "xfm" in sections.columns else [None] * len(sections),
+                      args.output, args.volume_type, args.stack_axis, args.round_offsets, args.slab_voxels)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import multiprocessing
+
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+import numpy as np
+import pandas as pd
+import scipy.fft
+
+from core.minc_header import minc_header
+
+FWHM_TO_SIGMA = 1 / (2 * np.sqrt(2 * np.log(2)))
+
+def kernel_transform(sizes, separations, fwhm):
+    """
+    The Fourier transform of a Gaussian of the given FWHM (in mm), normalized to sum to one like mincblur's,
+    on a grid of the given sizes and separations zero padded by three sigma. The Gaussian is separable, so
+    this is one small factor per axis, shaped to broadcast against rfftn's output. Returns the padded shape too.
+    """
+    sigmas = fwhm * FWHM_TO_SIGMA / np.abs(np.asarray(separations, dtype=float))
+    shape = tuple(scipy.fft.next_fast_len(int(size + np.ceil(3 * sigma)), real=True)
+                  for size, sigma in zip(sizes, sigmas))
+    frequencies = [scipy.fft.fftfreq(n) for n in shape[:-1]] + [scipy.fft.rfftfreq(shape[-1])]
+    factors = [np.exp(-2 * (np.pi * sigma * f) ** 2).astype(np.float32)
+                 .reshape([-1 if a == axis else 1 for a in range(len(shape))])
+               for axis, (sigma, f) in enumerate(zip(sigmas, frequencies))]
+    return shape, factors
+
+def blur(job, kernels):
+    """Convolve one volume with the kernel of its grid and FWHM, holding only it and its transform in memory."""
+    image, output, fwhm = job
+    header = minc_header(image)
+    shape, factors = kernels[tuple(header.sizes[:3]), tuple(header.separations[:3]), fwhm]
+    vol = volumeFromFile(image)
+    data = np.asarray(vol.data, dtype=np.float32)
+    vol.closeVolume()
+    spectrum = scipy.fft.rfftn(data, s=shape)
+    for factor in factors:
+        spectrum *= factor
+    blurred = scipy.fft.irfftn(spectrum, s=shape)
+    out = volumeLikeFile(image, output, volumeType="float")
+    out.data = blurred[tuple(slice(0, size) for size in data.shape)]
+    out.writeFile()
+    out.closeVolume()
+    return output
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Blur many volumes with Gaussians of one or more FWHMs by FFT "
+                                                 "convolution, as mincblur -fwhm would, transforming each "
+                                                 "kernel only once per grid and FWHM.")
+    parser.add_argument("jobs_csv", type=str, help="csv with input, output and fwhm (mm) columns, one row per blur")
+    parser.add_argument("--processes", dest="processes", type=int, default=1,
+                        help="Number of volumes to blur in parallel; each holds one padded volume and its "
+                             "transform in memory [default = %(default)s]")
+    args = parser.parse_args()
+
+    jobs = list(pd.read_csv(args.jobs_csv, dtype={"input": str, "output": str, "fwhm": float})
+                [["input", "output", "fwhm"]].itertuples(index=False, name=None))
+    # the kernels are built in the parent, from the headers alone, and shared by every volume on their grid
+    kernels = {}
+    for image, output, fwhm in jobs:
+        header = minc_header(image)
+        key = (tuple(header.sizes[:3]), tuple(header.separations[:3]), fwhm)
+        if key not in kernels:
+            kernels[key] = kernel_transform(*key)
+    pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+    for output in (pool.imap_unordered if pool else map)(functools.partial(blur, kernels=kernels), jobs):
+        print("Wrote %s" % output)
+    if pool:
+        pool.close()
+        pool.join()
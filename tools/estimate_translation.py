@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from pyminc.volumes.factory import volumeFromFile
+import numpy as np
+import scipy.fft
+import scipy.ndimage
+
+WORLD_AXES = ("xspace", "yspace", "zspace")
+
+def read_volume(path):
+    """The data of a MINC volume as float32, with its dimension names, starts and separations."""
+    vol = volumeFromFile(path)
+    data = np.asarray(vol.data, dtype=np.float32)
+    dimnames, starts, separations = list(vol.dimnames), np.array(vol.starts), np.array(vol.separations)
+    vol.closeVolume()
+    return data, dimnames, starts, separations
+
+def winsorize(a, lower=0.01, upper=0.99):
+    """Clip a to its lower and upper quantiles, as antsRegistration's --winsorize-image-intensities does."""
+    low, high = np.quantile(a, [lower, upper])
+    return np.clip(a, low, high)
+
+def shrink(a, factor, sigma):
+    """Smooth a by sigma (in voxels of a) and keep every factor-th voxel along each axis."""
+    if sigma > 0:
+        a = scipy.ndimage.gaussian_filter(a, sigma)
+    return a[tuple(slice(None, None, factor) for _ in range(a.ndim))]
+
+def phase_correlate(fixed, moving, predicted, radius):
+    """
+    The integer shift d, within radius of predicted, for which fixed[i] best matches moving[i - d]. Both
+    volumes are placed on a zero padded canvas, with moving already shifted by predicted, so only the
+    residual has to be found and it can't wrap around. Returns the shift and the correlation surface
+    around it (3 voxels per axis) for sub-voxel refinement.
+    """
+    predicted = np.asarray(predicted, dtype=int)
+    origin = np.minimum(0, predicted)
+    extent = np.maximum(fixed.shape, predicted + moving.shape) - origin
+    shape = [scipy.fft.next_fast_len(int(n + 2 * r + 2)) for n, r in zip(extent, radius)]
+    f = np.zeros(shape, dtype=np.float32)
+    m = np.zeros(shape, dtype=np.float32)
+    f[tuple(slice(-o, -o + n) for o, n in zip(origin, fixed.shape))] = fixed
+    m[tuple(slice(p - o, p - o + n) for p, o, n in zip(predicted, origin, moving.shape))] = moving
+    cross = scipy.fft.rfftn(f, workers=-1) * np.conj(scipy.fft.rfftn(m, workers=-1))
+    cross /= np.abs(cross) + 1e-6 * np.abs(cross).max()
+    surface = scipy.fft.irfftn(cross, shape, workers=-1)
+    # only residuals within radius are candidates
+    window = np.ix_(*[np.arange(-r, r + 1) % n for r, n in zip(radius, shape)])
+    candidates = surface[window]
+    peak = np.array(np.unravel_index(np.argmax(candidates), candidates.shape)) - radius
+    neighbourhood = surface[np.ix_(*[np.arange(p - 1, p + 2) % n for p, n in zip(peak, shape)])]
+    return predicted + peak, neighbourhood
+
+def subvoxel_offset(neighbourhood):
+    """Fit a parabola through the peak and its two neighbours along each axis of a 3x3x... neighbourhood."""
+    centre = tuple([1] * neighbourhood.ndim)
+    offset = np.zeros(neighbourhood.ndim)
+    for axis in range(neighbourhood.ndim):
+        before = list(centre); before[axis] = 0
+        after = list(centre); after[axis] = 2
+        low, mid, high = neighbourhood[tuple(before)], neighbourhood[centre], neighbourhood[tuple(after)]
+        curvature = low - 2 * mid + high
+        if curvature < 0:
+            offset[axis] = np.clip(0.5 * (low - high) / curvature, -0.5, 0.5)
+    return offset
+
+def estimate_shift(fixed, moving, shrink_factors=(8, 4, 2, 1), smoothing_sigmas=(3, 2, 1, 0)):
+    """
+    The shift d, in voxels, for which fixed[i] best matches moving[i - d], found by phase correlation on a
+    pyramid: an exhaustive search at the coarsest level, then a search within a couple of voxels of the
+    previous level's answer at each finer one, and a parabolic sub-voxel refinement at full resolution
+    (which is added as a last, unsmoothed level if the pyramid stops short of it).
+    smoothing_sigmas are in full resolution voxels, like antsRegistration's --smoothing-sigmas ...vox.
+    """
+    levels = list(zip(shrink_factors, smoothing_sigmas))
+    if levels[-1][0] != 1:
+        # a peak found on a shrunk grid can only land on every factor-th voxel
+        levels.append((1, 0))
+    shift, previous_factor = None, None
+    for factor, sigma in levels:
+        f = shrink(fixed, factor, sigma / factor)
+        m = shrink(moving, factor, sigma / factor)
+        if shift is None:
+            predicted = np.zeros(f.ndim, dtype=int)
+            radius = np.maximum(f.shape, m.shape)
+        else:
+            predicted = np.round(shift / factor).astype(int)
+            radius = np.full(f.ndim, previous_factor // factor + 1)
+        level_shift, neighbourhood = phase_correlate(f, m, predicted, radius)
+        shift, previous_factor = level_shift.astype(float) * factor, factor
+    return shift + subvoxel_offset(neighbourhood)
+
+def write_translation_xfm(path, translation, comment=""):
+    """Write translation (x, y, z in mm) as an MNI linear transform file."""
+    with open(path, "w") as f:
+        f.write("MNI Transform File\n")
+        if comment:
+            f.write("%%%s\n" % comment)
+        f.write("\nTransform_Type = Linear;\nLinear_Transform =\n")
+        f.write(" 1 0 0 %.10g\n 0 1 0 %.10g\n 0 0 1 %.10g;\n" % tuple(translation))
+
+def read_translation_xfm(path):
+    """The translation (x, y, z in mm) of an MNI linear transform file; any other part of it is ignored."""
+    with open(path) as f:
+        text = f.read()
+    values = text.split("Linear_Transform =")[1].replace(";", " ").split()[:12]
+    return np.array([float(values[3]), float(values[7]), float(values[11])])
+
+def world_translation(shift, dimnames, separations, fixed_starts, moving_starts):
+    """
+    The world translation (x, y, z) taking moving onto fixed, given the voxel shift d for which fixed[i]
+    matches moving[i - d]: moving voxel j lands on fixed voxel j + d.
+    """
+    translation = np.zeros(3)
+    for axis, dimname in enumerate(dimnames):
+        translation[WORLD_AXES.index(dimname)] = \
+            fixed_starts[axis] - moving_starts[axis] + shift[axis] * separations[axis]
+    return translation
+
+def parse_factors(value):
+    return [float(v) for v in value.replace("vox", "").split("x")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the translation aligning one MINC volume to another "
+                                                 "by multi-scale phase correlation and write it as an .xfm. "
+                                                 "The transform maps moving onto fixed, so "
+                                                 "'mincresample -transform xfm -like fixed moving' aligns them.")
+    parser.add_argument("fixed", type=str)
+    parser.add_argument("moving", type=str)
+    parser.add_argument("output_xfm", type=str)
+    parser.add_argument("--shrink-factors", dest="shrink_factors", type=str, default="8x4x2x1",
+                        help="Downsampling factor of each level, coarsest first [default = %(default)s]")
+    parser.add_argument("--smoothing-sigmas", dest="smoothing_sigmas", type=str, default="3x2x1x0",
+                        help="Gaussian smoothing of each level in full resolution voxels [default = %(default)s]")
+    parser.add_argument("--no-winsorize", dest="winsorize", action="store_false", default=True,
+                        help="Don't clip intensities to their 1st and 99th percentiles first")
+    args = parser.parse_args()
+
+    fixed, dimnames, fixed_starts, separations = read_volume(args.fixed)
+    moving, moving_dimnames, moving_starts, moving_separations = read_volume(args.moving)
+    if moving_dimnames != dimnames:
+        parser.error("%s and %s have different dimension orders" % (args.fixed, args.moving))
+    if not np.allclose(moving_separations, separations):
+        # put moving on fixed's voxel grid, keeping its first voxel where it is
+        moving = scipy.ndimage.zoom(moving, moving_separations / separations, order=1)
+    if args.winsorize:
+        fixed, moving = winsorize(fixed), winsorize(moving)
+
+    shift = estimate_shift(fixed, moving,
+                           [int(factor) for factor in parse_factors(args.shrink_factors)],
+                           parse_factors(args.smoothing_sigmas))
+    translation = world_translation(shift, dimnames, separations, fixed_starts, moving_starts)
+    print("Translation (x, y, z):", translation)
+    write_translation_xfm(args.output_xfm, translation,
+                          "Created by estimate_translation.py %s %s" % (args.fixed, args.moving))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import multiprocessing
+
+from pyminc.volumes.factory import volumeFromFile
+import numpy as np
+import pandas as pd
+
+def regional_counts(count_path, label_path, block_size=2 ** 22):
+    """
+    For every label in the label volume, the number of voxels it covers and the sum of the count volume
+    over them. Both volumes are read a slab at a time and each slab is reduced with np.bincount over its
+    labels' indices, so neither is ever held in memory whole.
+    """
+    counts, labels = volumeFromFile(count_path), volumeFromFile(label_path)
+    sizes = labels.sizes[:3]
+    if list(counts.sizes[:3]) != list(sizes):
+        raise ValueError("%s and %s are on different grids" % (count_path, label_path))
+    voxel_volume = abs(np.prod(labels.separations[:3]))
+    slab = max(1, block_size // int(np.prod(sizes[1:])))
+    chunks = []
+    for start in range(0, sizes[0], slab):
+        count = (min(slab, sizes[0] - start), sizes[1], sizes[2])
+        label_slab = np.rint(labels.getHyperslab((start, 0, 0), count)).astype(np.int64).ravel()
+        count_slab = np.asarray(counts.getHyperslab((start, 0, 0), count), dtype=float).ravel()
+        # label values can be large and sparse (structure ids), so count over their indices
+        chunk_labels, inverse = np.unique(label_slab, return_inverse=True)
+        chunks.append((chunk_labels,
+                       np.bincount(inverse, minlength=len(chunk_labels)),
+                       np.bincount(inverse, weights=count_slab, minlength=len(chunk_labels))))
+    counts.closeVolume()
+    labels.closeVolume()
+
+    chunk_labels, voxels, sums = (np.concatenate(column) for column in zip(*chunks))
+    all_labels, inverse = np.unique(chunk_labels, return_inverse=True)
+    voxels = np.bincount(inverse, weights=voxels, minlength=len(all_labels)).astype(np.int64)
+    sums = np.bincount(inverse, weights=sums, minlength=len(all_labels))
+    return pd.DataFrame({"label": all_labels,
+                         "voxels": voxels,
+                         "volume": voxels * voxel_volume,
+                         "count": sums,
+                         "density": sums / (voxels * voxel_volume)})
+
+def subject_counts(job, include_background=False):
+    subject, count_path, label_path = job
+    table = regional_counts(count_path, label_path)
+    if not include_background:
+        table = table[table.label != 0]
+    return table.assign(subject=subject)[["subject", "label", "voxels", "volume", "count", "density"]]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sum count volumes over the structures of label volumes and "
+                                                 "write the count, volume (mm^3) and density of every label "
+                                                 "of every subject as one table.")
+    parser.add_argument("jobs_csv", type=str, help="csv with subject, count and label columns, one row per subject")
+    parser.add_argument("output_csv", type=str)
+    parser.add_argument("--processes", dest="processes", type=int, default=1,
+                        help="Number of subjects to process in parallel [default = %(default)s]")
+    parser.add_argument("--include-background", dest="include_background", action="store_true", default=False,
+                        help="Keep label 0 in the table")
+    args = parser.parse_args()
+
+    jobs = list(pd.read_csv(args.jobs_csv, dtype=str)[["subject", "count", "label"]].itertuples(index=False, name=None))
+    count = functools.partial(subject_counts, include_background=args.include_background)
+    pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+    tables = list(pool.imap(count, jobs) if pool else map(count, jobs))
+    if pool:
+        pool.close()
+        pool.join()
+    pd.concat(tables, ignore_index=True).to_csv(args.output_csv, index=False)
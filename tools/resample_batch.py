@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import tempfile
+
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+import numpy as np
+import scipy.ndimage
+
+from core.minc_header import WORLD_AXES, minc_header, minc_direction_cosines
+
+INTERPOLATION_ORDERS = {"nearest": 0, "trilinear": 1, "tricubic": 3}
+
+def check_axis_aligned(path):
+    """Reject a volume whose dimensions don't lie along their world axes: voxel to world is taken as start + i * step."""
+    dimnames = [dimname for dimname in minc_header(path).dimnames if dimname in WORLD_AXES]
+    if not np.allclose(minc_direction_cosines(path), np.eye(3)[[WORLD_AXES.index(d) for d in dimnames]], atol=1e-6):
+        raise ValueError("%s has direction cosines that aren't along its world axes, which this tool doesn't "
+                         "support; use mincresample" % path)
+
+def read_volume(path, order=0):
+    """
+    The data of a MINC volume as float32, spline filtered for interpolation of the given order above 1, with
+    its dimension names, starts and separations.
+    """
+    check_axis_aligned(path)
+    vol = volumeFromFile(path)
+    data = np.asarray(vol.data, dtype=np.float32)
+    dimnames, starts, separations = list(vol.dimnames), np.array(vol.starts), np.array(vol.separations)
+    vol.closeVolume()
+    if order > 1:
+        # done once here rather than by map_coordinates for every slab
+        data = scipy.ndimage.spline_filter(data, order=order, output=np.float32, mode="constant")
+    return data, dimnames, starts, separations
+
+def source_displacements(xfm, like, invert, tmp_dir):
+    """
+    A displacement volume giving, on every voxel of like, the displacement from that voxel's world position
+    to the point in the source image that mincresample -transform xfm [-invert_transformation] -like like
+    would sample there. The transform (or its inverse) is evaluated once, with minc_displacement. Returns the
+    volume open, to be read a slab at a time.
+    """
+    if not invert:
+        # mincresample maps the target grid back through the inverse of the transform
+        inverted = os.path.join(tmp_dir, "inverted.xfm")
+        subprocess.check_call(["xfminvert", "-clobber", xfm, inverted])
+        xfm = inverted
+    displacement = os.path.join(tmp_dir, "displacement.mnc")
+    subprocess.check_call(["minc_displacement", "-clobber", like, xfm, displacement])
+    like_header, header = minc_header(like), minc_header(displacement)
+    spatial = [dimname for dimname in header.dimnames if dimname != "vector_dimension"]
+    if spatial != list(like_header.dimnames[:3]) or \
+            [header.sizes[header.dimnames.index(dimname)] for dimname in spatial] != list(like_header.sizes[:3]):
+        raise ValueError("the displacement field of %s isn't on %s's grid (%s)" % (xfm, like, ", ".join(spatial)))
+    check_axis_aligned(displacement)
+    return volumeFromFile(displacement)
+
+def read_displacement_slab(vol, start, stop):
+    """Slabs [start, stop) of the displacement volume vol, as float32 with the x, y, z components first."""
+    dimnames = list(vol.dimnames)
+    spatial = [axis for axis, dimname in enumerate(dimnames) if dimname != "vector_dimension"]
+    starts = [start if axis == spatial[0] else 0 for axis in range(len(dimnames))]
+    counts = [stop - start if axis == spatial[0] else size for axis, size in enumerate(vol.sizes[:len(dimnames)])]
+    slab = np.asarray(vol.getHyperslab(starts, counts), dtype=np.float32)
+    return np.moveaxis(slab, dimnames.index("vector_dimension"), 0)
+
+def resample_images(jobs, xfm, like, invert=False, block_size=2 ** 22):
+    """
+    Resample each (input, output, interpolation) of jobs onto like's grid through xfm. The transform is
+    evaluated once and every image is sampled from it in the same pass, with the displacement field read a
+    slab of like at a time.
+    """
+    check_axis_aligned(like)
+    like_header = minc_header(like)
+    shape = tuple(like_header.sizes[:3])
+    like_dimnames, like_starts, like_separations = like_header.dimnames, like_header.starts, like_header.separations
+    # world position of every voxel of like along each of its axes, to broadcast against the others
+    positions = [(like_starts[axis] + np.arange(n, dtype=np.float32) * like_separations[axis])
+                 .reshape([-1 if a == axis else 1 for a in range(3)]) for axis, n in enumerate(shape)]
+
+    images = [read_volume(image, INTERPOLATION_ORDERS[interpolation]) for image, output, interpolation in jobs]
+    resampled = [np.zeros(shape, dtype=np.float32) for _ in jobs]
+    slab = max(1, block_size // int(np.prod(shape[1:])))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        displacement_vol = source_displacements(xfm, like, invert, tmp_dir)
+        for start in range(0, shape[0], slab):
+            stop = min(start + slab, shape[0])
+            displacement = read_displacement_slab(displacement_vol, start, stop)
+            # the source point of every voxel of this slab of like
+            source = {dimname: (positions[axis][start:stop] if axis == 0 else positions[axis])
+                               + displacement[WORLD_AXES.index(dimname)]
+                      for axis, dimname in enumerate(like_dimnames)}
+            for (data, dimnames, starts, separations), output, (image, output_path, interpolation) \
+                    in zip(images, resampled, jobs):
+                coordinates = [(source[dimname] - starts[axis]) / separations[axis]
+                               for axis, dimname in enumerate(dimnames)]
+                output[start:stop] = scipy.ndimage.map_coordinates(data, coordinates,
+                                                                   order=INTERPOLATION_ORDERS[interpolation],
+                                                                   mode="constant", cval=0, prefilter=False)
+        displacement_vol.closeVolume()
+
+    for (image, output_path, interpolation), output in zip(jobs, resampled):
+        # labels keep their exact values, as with mincresample -keep_real_range
+        labels = interpolation == "nearest"
+        out = volumeLikeFile(like, output_path, volumeType="uint" if labels else "ushort", labels=labels)
+        out.data = np.round(output) if labels else output
+        out.writeFile()
+        out.closeVolume()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resample several images onto the same grid through the same "
+                                                 "transform, evaluating the transform only once, as a series of "
+                                                 "'mincresample -transform xfm -like like' calls would.")
+    parser.add_argument("--transform", dest="transform", type=str, required=True)
+    parser.add_argument("--like", dest="like", type=str, required=True)
+    parser.add_argument("--invert-transformation", dest="invert", action="store_true", default=False)
+    parser.add_argument("--image", dest="images", nargs=3, action="append", required=True,
+                        metavar=("INPUT", "OUTPUT", "INTERPOLATION"),
+                        help="An image to resample, where to write it, and how to interpolate it (%s). "
+                             "Give once per image." % ", ".join(INTERPOLATION_ORDERS))
+    args = parser.parse_args()
+
+    for image, output, interpolation in args.images:
+        if interpolation not in INTERPOLATION_ORDERS:
+            parser.error("unknown interpolation %s for %s" % (interpolation, image))
+    resample_images(args.images, args.transform, args.like, args.invert)
@@ -1,4 +1,8 @@
 import os
+import functools
+import hashlib
+import json
+import multiprocessing
 
 from pyminc.volumes.factory import *
 import numpy as np
@@ -109,6 +113,294 @@ def congrid(a, newdims, method='linear', centre=False, minusone=False):
               "and \'spline\' are supported.")
         return None
 
+def window_sums(a, windows, axis):
+    """
+    Sum the 2D array a along axis over each of windows, a list of (starts, size) pairs describing the
+    windows [start, start + size), treating indices outside the array the way scipy.ndimage's default
+    'reflect' mode does. Windows that tile the axis are summed in a single strided pass; the others are
+    read off one integral image, shared between them and built a block of rows at a time.
+    """
+    a = np.moveaxis(a, axis, -1)
+    n = a.shape[-1]
+    sums = [np.empty((a.shape[0], len(starts))) for starts, size in windows]
+    integral_windows = []
+    for (starts, size), s in zip(windows, sums):
+        m, h = len(starts), size // 2
+        if np.array_equal(starts, np.arange(m) * size - h) and h <= n and m * size - h <= n:
+            # the first window hangs over the edge and picks up the mirrored first h pixels
+            s[:, 0] = a[:, :size - h].sum(axis=-1) + a[:, :h].sum(axis=-1)
+            s[:, 1:] = a[:, size - h:m * size - h].reshape((a.shape[0], m - 1, size)).sum(axis=-1)
+        else:
+            integral_windows.append((starts, size, s))
+    if integral_windows:
+        pad = max(size for starts, size, s in integral_windows)
+        chunk = max(1, 2 ** 22 // (n + 2 * pad))
+        for r in range(0, a.shape[0], chunk):
+            padded = np.pad(a[r:r + chunk], ((0, 0), (pad, pad)), mode="symmetric")
+            integral = np.cumsum(padded, axis=-1)
+            for starts, size, s in integral_windows:
+                s[r:r + chunk] = integral[:, starts + pad + size - 1] - integral[:, starts + pad - 1]
+    return [np.moveaxis(s, -1, axis) for s in sums]
+
+# blur (in pixels of the level being decimated) before each decimation by 2: about 0.8 pixels of the
+# decimated level, which leaves under 5% of the signal at its Nyquist frequency to alias
+PYRAMID_OCTAVE_SIGMA = 1.6
+
+def pyramid_octaves(ratio, sigma, octave_sigma=PYRAMID_OCTAVE_SIGMA):
+    """
+    Number of times the Gaussian pyramid blurs and decimates by 2 before the final blur: it stops once
+    the next octave would overshoot the output grid or leave less than a pixel of blur.
+    """
+    octaves, variance = 0, 0.0
+    while 2 ** (octaves + 1) <= ratio and \
+            sigma ** 2 - variance - (octave_sigma * 2 ** octaves) ** 2 >= 4 ** (octaves + 1):
+        variance += (octave_sigma * 2 ** octaves) ** 2
+        octaves += 1
+    return octaves
+
+def pyramid_halo(sigma, octaves, octave_sigma=PYRAMID_OCTAVE_SIGMA):
+    """Input pixels on either side of an output sample that its pyramid filters reach, plus a decimated pixel."""
+    return int(np.ceil(4 * (octave_sigma * (2 ** octaves - 1) + sigma))) + 2 ** octaves
+
+def pyramid_reduce_axis(a, axis, targets, octave_sigma=PYRAMID_OCTAVE_SIGMA):
+    """
+    Approximate gaussian_filter1d followed by point sampling along axis by repeatedly blurring with a
+    small kernel and decimating by 2 until close to the output grid, then applying the remaining blur
+    (Gaussian variances add) and sampling at low resolution. targets is a list of (centres, sigma,
+    octaves); the octaves are shared, each target branching off once the pyramid is deep enough for it.
+
+    The axis is first padded at full resolution the way gaussian_filter1d extends it, so that the
+    decimated levels don't reflect about the wrong edge. benchmarks/pyramid_accuracy.py checks the
+    result against gaussian_filter1d.
+    """
+    factor = 2 ** max(octaves for centres, sigma, octaves in targets)
+    pad = -(-max(pyramid_halo(sigma, octaves, octave_sigma) for centres, sigma, octaves in targets)
+            // factor) * factor
+    a = np.pad(a, [(pad, pad) if i == axis else (0, 0) for i in range(a.ndim)], mode="symmetric")
+    results = [None] * len(targets)
+    level = 0
+    for k in sorted(range(len(targets)), key=lambda k: targets[k][2]):
+        centres, sigma, octaves = targets[k]
+        for _ in range(level, octaves):
+            a = scipy.ndimage.gaussian_filter1d(a, octave_sigma, axis=axis)
+            a = a[::2] if axis == 0 else a[:, ::2]
+        level = max(level, octaves)
+        factor = 2 ** octaves
+        variance = octave_sigma ** 2 * (4 ** octaves - 1) / 3
+        blurred = scipy.ndimage.gaussian_filter1d(a, np.sqrt(sigma ** 2 - variance) / factor, axis=axis)
+        # pixel i of the decimated axis sits on input pixel factor * i - pad; interpolate rather than snap to it
+        coords = np.clip((np.asarray(centres) + pad) / factor, 0, blurred.shape[axis] - 1)
+        low = np.floor(coords).astype(int)
+        high = np.minimum(low + 1, blurred.shape[axis] - 1)
+        weight = (coords - low).reshape((-1, 1) if axis == 0 else (1, -1))
+        results[k] = blurred.take(low, axis) * (1 - weight) + blurred.take(high, axis) * weight
+    return results
+
+def reduce_axis(a, axis, targets, args):
+    """
+    Smooth a along a single axis as args asks for and sample it, once for each of targets, a list of
+    (centres, filter_size, octaves) describing one output grid along that axis. Every preprocessing
+    option is separable, so doing this for both axes is the same as filtering the whole slice.
+
+    The uniform filters (unless args.full_resolution_filter) only sum the footprints that get sampled,
+    and the pyramid only filters at full resolution with a small kernel; intermediates are shared by
+    all of the targets.
+    """
+    if args.preprocess == "gaussian" and args.pyramid:
+        return pyramid_reduce_axis(a, axis, targets)
+    if args.preprocess in ("uniform", "uniform_sum") and not args.full_resolution_filter:
+        sums = window_sums(a, [(centres - int(filter_size) // 2, int(filter_size))
+                               for centres, filter_size, octaves in targets], axis)
+        if args.preprocess == "uniform_sum":
+            return sums
+        return [s / int(filter_size) for s, (centres, filter_size, octaves) in zip(sums, targets)]
+    results = []
+    for centres, filter_size, octaves in targets:
+        if args.preprocess in ("uniform", "uniform_sum"):
+            b = scipy.ndimage.uniform_filter1d(a, int(filter_size), axis=axis).take(centres, axis)
+            results.append(b * int(filter_size) if args.preprocess == "uniform_sum" else b)
+        elif args.preprocess == "gaussian":
+            results.append(scipy.ndimage.gaussian_filter1d(a, filter_size, axis=axis).take(centres, axis))
+        else:
+            results.append(a.take(centres, axis))
+    return results
+
+def output_grid(slice_shape, input_resolution, output_resolution):
+    """The output slice size and filter size (in input pixels) for one output resolution."""
+    output_size = np.ceil(np.asarray(slice_shape) * (input_resolution / output_resolution)).astype('int')
+    filter_size = np.ceil(slice_shape[0] / output_size[0])
+    return output_size, filter_size
+
+def slice_targets(slice_shape, output_sizes, filter_sizes, args):
+    """The reduce_axis targets of every output grid, for the rows and then for the columns of a slice."""
+    rows, columns = [], []
+    for output_size, filter_size in zip(output_sizes, filter_sizes):
+        ratio = np.asarray(slice_shape) / output_size
+        octaves = pyramid_octaves(ratio.min(), filter_size) \
+            if args.preprocess == "gaussian" and args.pyramid else 0
+        # the same sample points congrid(..., 'neighbour') uses
+        centres = [np.round(np.arange(output_size[i]) * ratio[i]).astype(int) for i in range(2)]
+        rows.append((centres[0], filter_size, octaves))
+        columns.append((centres[1], filter_size, octaves))
+    return rows, columns
+
+def output_filenames(output_image, output_resolutions):
+    """One file per output resolution, suffixed with the resolution in um when there is more than one."""
+    if len(output_resolutions) == 1:
+        return [output_image]
+    base, ext = os.path.splitext(output_image)
+    return ["%s_%gum%s" % (base, 1000 * resolution, ext) for resolution in output_resolutions]
+
+def open_slice(image):
+    """Memory map image if its pixels are stored contiguously, so that it can be read a strip at a time."""
+    try:
+        import tifffile
+        return tifffile.memmap(image, mode="r")
+    except (ImportError, ValueError):
+        return scipy.ndimage.imread(image)
+
+def process_slice_in_strips(image, output_sizes, filter_sizes, args):
+    """
+    process_slice, reading the slice one block of rows at a time and reducing each block's columns
+    straight away for every output grid. Output rows are produced args.strip_rows at a time, as soon
+    as the rows they need (plus a halo wide enough for the filter) have been read, and rows are dropped
+    once no later output row needs them.
+    """
+    imslice = open_slice(image)
+    n_rows = imslice.shape[0]
+    scale = args.scale_output / np.iinfo(imslice.dtype).max
+    rows, columns = slice_targets(imslice.shape, output_sizes, filter_sizes, args)
+    halos = [pyramid_halo(filter_size, octaves) for centres, filter_size, octaves in rows]
+    read_rows = max(1, 2 ** 22 // imslice.shape[1])
+
+    o_imslices = [np.empty(output_size) for output_size in output_sizes]
+    # for each grid: rows [reduced_start, reduced_start + len(reduced)) of the slice, with their
+    # columns already reduced, and the next output row to produce
+    reduced = [np.empty((0, output_size[1])) for output_size in output_sizes]
+    reduced_start = [0] * len(output_sizes)
+    next_row = [0] * len(output_sizes)
+    for r in range(0, n_rows, read_rows):
+        rows_read = min(r + read_rows, n_rows)
+        block = np.asarray(imslice[r:rows_read], dtype=float) * scale
+        for k, block_columns in enumerate(reduce_axis(block, 1, columns, args)):
+            centres, filter_size, octaves = rows[k]
+            factor = 2 ** octaves
+            reduced[k] = np.concatenate([reduced[k], block_columns])
+            # output rows whose halo has been read in full
+            ready = len(centres) if rows_read == n_rows else \
+                np.searchsorted(centres, rows_read - halos[k] - 1, side="right")
+            if ready < len(centres) and ready - next_row[k] < args.strip_rows:
+                continue
+            if ready > next_row[k]:
+                o_imslices[k][next_row[k]:ready] = reduce_axis(
+                    reduced[k], 0, [(centres[next_row[k]:ready] - reduced_start[k], filter_size, octaves)],
+                    args)[0]
+                next_row[k] = ready
+            if ready < len(centres):
+                # keep the start of the buffer on the decimated grid of the pyramid
+                start = min(max(0, centres[ready] - halos[k]), rows_read) // factor * factor
+                if start > reduced_start[k]:
+                    reduced[k] = reduced[k][start - reduced_start[k]:]
+                    reduced_start[k] = start
+    return o_imslices
+
+def process_slice(image, output_sizes, filter_sizes, args):
+    """Read a single slice, then normalize, smooth and downsample it to each of output_sizes."""
+    if args.strip_rows:
+        return process_slice_in_strips(image, output_sizes, filter_sizes, args)
+    imslice = scipy.ndimage.imread(image)
+    # normalize slice to lie between 0 and 1
+    original_type_max = np.iinfo(imslice.dtype).max
+    imslice = imslice.astype('float')
+    imslice = imslice * (args.scale_output/original_type_max)
+
+    if (args.preprocess in ("uniform", "uniform_sum") and not args.full_resolution_filter) or \
+            (args.preprocess == "gaussian" and args.pyramid):
+        rows, columns = slice_targets(imslice.shape, output_sizes, filter_sizes, args)
+        return [reduce_axis(reduced, 0, [row], args)[0]
+                for reduced, row in zip(reduce_axis(imslice, 1, columns, args), rows)]
+
+    o_imslices = []
+    for output_size, filter_size in zip(output_sizes, filter_sizes):
+        # smooth the data depending on the chosen option
+        smoothed = imslice
+        if args.preprocess=="gaussian":
+            smoothed = scipy.ndimage.gaussian_filter(imslice, sigma=filter_size)
+        if args.preprocess=="uniform" or args.preprocess=="uniform_sum":
+            smoothed = scipy.ndimage.uniform_filter(imslice, size=filter_size)
+        if args.preprocess=="uniform_sum":
+            smoothed = smoothed * filter_size * filter_size
+
+        # downsample the slice
+        o_imslices.append(congrid(smoothed, output_size, 'neighbour'))
+    return o_imslices
+
+def output_slices(image, output_sizes, filter_sizes, output_maxes, args):
+    """process_slice, converted to what gets written to the volumes when streaming."""
+    o_imslices = process_slice(image, output_sizes, filter_sizes, args)
+    if args.stream:
+        # the volumes' real ranges are fixed up front, so values beyond them
+        # can only be clipped; nothing downstream needs more than single precision
+        o_imslices = [np.clip(o_imslice, 0, output_max).astype(np.float32)
+                      for o_imslice, output_max in zip(o_imslices, output_maxes)]
+    return o_imslices
+
+def file_sha1(path, block_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def slice_entry(image):
+    """The manifest entry of one input slice: its path, size, modification time and content hash."""
+    stat = os.stat(image)
+    return {"path": image, "size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": file_sha1(image)}
+
+def unchanged_entry(image, previous):
+    """
+    The up to date manifest entry of image if it is the same slice as previous (the entry from the last
+    run), or None if it has to be processed again. Slices whose size and modification time are unchanged
+    are taken on trust; the others are hashed, so touching a file does not force it to be redone.
+    """
+    if previous["path"] != image:
+        return None
+    stat = os.stat(image)
+    if stat.st_size == previous["size"] and stat.st_mtime_ns == previous["mtime"]:
+        return previous
+    if stat.st_size != previous["size"] or file_sha1(image) != previous["sha1"]:
+        return None
+    return dict(previous, mtime=stat.st_mtime_ns)
+
+def manifest_options(args):
+    """Everything apart from the slices themselves that the contents of the output volumes depend on."""
+    options = {key: value for key, value in vars(args).items()
+               if key not in ("input_images", "output_image", "processes", "strip_rows", "incremental")}
+    options["slice_shape"] = [int(n) for n in args.slice_shape]
+    # compare against what comes back from the file, e.g. tuples as lists
+    return json.loads(json.dumps(options))
+
+def read_manifest(manifest, options, n_slices):
+    """The slice entries recorded in manifest, or None if it is missing or was written for other options."""
+    try:
+        with open(manifest) as f:
+            contents = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if contents.get("options") != options or len(contents.get("slices", [])) != n_slices:
+        return None
+    return contents["slices"]
+
+def write_manifest(manifest, options, entries):
+    # replace the old manifest in one step so it never describes a half written volume
+    with open(manifest + ".tmp", "w") as f:
+        json.dump({"options": options, "slices": entries}, f, indent=1)
+    os.replace(manifest + ".tmp", manifest)
+
+def with_manifest_entry(process, image):
+    """process(image), along with the manifest entry of image, hashed while its contents are likely cached."""
+    return process(image), slice_entry(image)
+
 
 if __name__ == "__main__":
     description = """
@@ -134,14 +426,45 @@ if __name__ == "__main__":
                           type=float, default=0.00137)
     size.add_argument("--output-resolution", dest="output_resolution",
                           help="The desired output resolution in mm (i.e. "
-                          "what the data will be resampled to) "
+                          "what the data will be resampled to). Give several "
+                          "to produce a volume at each of them from a single "
+                          "read of every slice; the resolution in um is then "
+                          "appended to the output file name "
                           "[default: %(default)s]",
-                          type=float, default=0.075)
+                          type=float, nargs="+", default=[0.075])
     size.add_argument("--slice-gap", dest="slice_gap",
                           help="The slice gap in mm (i.e. the distance "
                           "between adjacent slices)[default: %(default)s]",
                           type=float, default=0.075)
     # add option for explicitly giving output matrix size
+    parser.add_argument("--strip-rows", dest="strip_rows", type=int,
+                        default=None,
+                        help="Read and filter each slice this many output rows "
+                        "at a time (memory mapping the TIFF when its layout "
+                        "allows), instead of reading the whole slice into "
+                        "memory [default: whole slices]")
+    parser.add_argument("--stream", dest="stream", action="store_true",
+                        default=False,
+                        help="Write each slice to the output file as soon as "
+                        "it is done instead of holding the whole volume in "
+                        "memory. The volume's range is then fixed to "
+                        "[0, --output-max] before any slice is seen.")
+    parser.add_argument("--output-max", dest="output_max", type=float,
+                        default=None,
+                        help="Upper end of the output range when streaming; "
+                        "larger values are clipped [default: the largest value "
+                        "the chosen preprocessing can produce]")
+    parser.add_argument("--incremental", dest="incremental", action="store_true",
+                        default=False,
+                        help="Keep a manifest of the input slices (size, "
+                        "modification time and sha1) next to the output and, "
+                        "when the output and a manifest written with the same "
+                        "options already exist, only process the slices that "
+                        "changed and overwrite their hyperslabs in place. "
+                        "Implies --stream.")
+    parser.add_argument("--processes", dest="processes", type=int, default=1,
+                        help="Number of worker processes reading, filtering and "
+                        "downsampling slices in parallel [default: %(default)s]")
 
     preprocessing = parser.add_argument_group("preprocessing")
     preprocessing.add_argument("--scale-output", dest="scale_output",
@@ -164,6 +487,18 @@ if __name__ == "__main__":
                                    "this option if, for example, the slices "
                                    "contain classified neurons.",
                                    const="uniform_sum", dest="preprocess")
+    preprocessing.add_argument("--pyramid", action="store_true",
+                               dest="pyramid", default=False,
+                               help="For --gaussian, blur and decimate by 2 with small "
+                               "kernels until close to the output resolution and do "
+                               "the remaining smoothing there, instead of filtering "
+                               "the full resolution slice with the whole kernel")
+    preprocessing.add_argument("--full-resolution-filter", action="store_true",
+                               dest="full_resolution_filter", default=False,
+                               help="For --uniform and --uniform-sum, filter the whole "
+                               "full resolution slice and point sample it with congrid "
+                               "instead of summing each output pixel's footprint "
+                               "directly (slower, kept for validation)")
     
     dim = parser.add_mutually_exclusive_group()
     dim.add_argument("--xyz", action="store_const",
@@ -198,41 +533,92 @@ if __name__ == "__main__":
     # need to know the number of slices
     n_slices = len(args.input_images)
     # need to know the size of the output slices - read in a single slice
-    test_slice = scipy.ndimage.imread(args.input_images[0])
+    test_slice = open_slice(args.input_images[0])
     slice_shape = np.array(test_slice.shape)
-    size_fraction = args.input_resolution / args.output_resolution
-    output_size = np.ceil(slice_shape * size_fraction).astype('int')
-    filter_size = np.ceil(slice_shape[0] / output_size[0])
+    args.slice_shape = slice_shape
+    # incremental updates write into the existing volumes, whose range can't change
+    args.stream = args.stream or args.incremental
+    output_images = output_filenames(args.output_image, args.output_resolution)
+    output_sizes, filter_sizes = zip(*[output_grid(slice_shape, args.input_resolution, output_resolution)
+                                       for output_resolution in args.output_resolution])
 
-    vol = volumeFromDescription(args.output_image,
-                                args.dimorder,
-                                sizes=(n_slices,output_size[0],output_size[1]),
-                                starts=(0,0,0),
-                                steps=(args.slice_gap,
-                                       args.output_resolution,
-                                       args.output_resolution),
-                                volumeType='ushort')
-    for i in range(n_slices):
-        print("In slice", i+1, "out of", n_slices)
-        imslice = scipy.ndimage.imread(args.input_images[i])
-        # normalize slice to lie between 0 and 1
-        original_type_max = np.iinfo(imslice.dtype).max
-        imslice = imslice.astype('float')
-        imslice = imslice * (args.scale_output/original_type_max)
+    # the largest value any of the preprocessing options can produce
+    output_maxes = [args.output_max if args.output_max is not None else
+                    args.scale_output * (filter_size * filter_size
+                                         if args.preprocess == "uniform_sum"
+                                         else 1)
+                    for filter_size in filter_sizes]
 
-        # smooth the data depending on the chosen option
-        if args.preprocess=="gaussian":
-            imslice = scipy.ndimage.gaussian_filter(imslice, sigma=filter_size)
-        if args.preprocess=="uniform" or args.preprocess=="uniform_sum":
-            imslice = scipy.ndimage.uniform_filter(imslice, size=filter_size)
-        if args.preprocess=="uniform_sum":
-            imslice = imslice * filter_size * filter_size
+    # the slices to process: all of them, unless an incremental update can
+    # reuse the existing volumes
+    todo = list(range(n_slices))
+    if args.incremental:
+        manifest = args.output_image + ".manifest.json"
+        options = manifest_options(args)
+        previous = read_manifest(manifest, options, n_slices) \
+            if all(os.path.exists(output_image) for output_image in output_images) else None
+        if previous is None:
+            entries = [None] * n_slices
+            # a rebuild that dies half way must not leave the old manifest vouching for it
+            if os.path.exists(manifest):
+                os.remove(manifest)
+        else:
+            entries = [unchanged_entry(image, entry) for image, entry in zip(args.input_images, previous)]
+            todo = [i for i, entry in enumerate(entries) if entry is None]
+            print("Updating", len(todo), "of", n_slices, "slices")
 
-        # downsample the slice
-        o_imslice = congrid(imslice, output_size, 'neighbour')
-        # add the downsampled slice to the volume
-        vol.data[i,:,:] = o_imslice
+    process = functools.partial(output_slices, output_sizes=output_sizes,
+                                filter_sizes=filter_sizes,
+                                output_maxes=output_maxes, args=args)
+    if args.incremental:
+        process = functools.partial(with_manifest_entry, process)
+    if args.processes > 1:
+        # workers read, filter and downsample slices; this process is the
+        # only one writing to the volumes and receives the slices in order.
+        # Start the pool before opening the volumes so no worker inherits them.
+        pool = multiprocessing.Pool(args.processes)
+        o_imslices = pool.imap(process, [args.input_images[i] for i in todo])
+    else:
+        o_imslices = map(process, [args.input_images[i] for i in todo])
+
+    if len(todo) < n_slices:
+        vols = [volumeFromFile(output_image, readonly=False) for output_image in output_images]
+    else:
+        vols = [volumeFromDescription(output_image,
+                                      args.dimorder,
+                                      sizes=(n_slices,output_size[0],output_size[1]),
+                                      starts=(0,0,0),
+                                      steps=(args.slice_gap,
+                                             output_resolution,
+                                             output_resolution),
+                                      volumeType='ushort')
+                for output_image, output_size, output_resolution
+                in zip(output_images, output_sizes, args.output_resolution)]
+        if args.stream:
+            # without the whole volume at hand, the real range has to be set
+            # before any slice is written
+            for vol, output_max in zip(vols, output_maxes):
+                vol.setVolumeRanges(np.array([0, output_max]))
+    for i, slice_outputs in zip(todo, o_imslices):
+        print("In slice", i+1, "out of", n_slices)
+        if args.incremental:
+            slice_outputs, entries[i] = slice_outputs
+        for vol, o_imslice in zip(vols, slice_outputs):
+            if args.stream:
+                # write the slice straight to its hyperslab and let it go
+                vol.setHyperslab(o_imslice[np.newaxis, :, :], start=(i, 0, 0),
+                                 count=(1,) + o_imslice.shape)
+            else:
+                # add the downsampled slice to the volume
+                vol.data[i,:,:] = o_imslice
+    if args.processes > 1:
+        pool.close()
+        pool.join()
 
-    # finish: write the volume to file
-    vol.writeFile()
-    vol.closeVolume()
+    # finish: write the volumes to file
+    for vol in vols:
+        if not args.stream:
+            vol.writeFile()
+        vol.closeVolume()
+    if args.incremental:
+        write_manifest(manifest, options, entries)
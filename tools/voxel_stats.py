@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import multiprocessing
+import os
+import re
+
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+import numpy as np
+import pandas as pd
+
+from core.minc_header import minc_header
+
+def design_matrix(analysis, predictors):
+    """
+    An intercept plus the predictors columns of analysis; numeric columns are used as they are and the
+    others are dummy coded against their first level. Returns the matrix and the name of each column.
+    """
+    design = pd.get_dummies(analysis[predictors], drop_first=True, dtype=float)
+    design.insert(0, "intercept", 1.0)
+    return design.values, list(design.columns)
+
+# the volumes to model and the mask (or None), opened once in each process that fits blocks
+_volumes = None
+
+def open_volumes(paths, mask):
+    """Open the volumes and mask for every block this process will fit (a Pool initializer)."""
+    global _volumes
+    _volumes = [volumeFromFile(path) for path in paths], volumeFromFile(mask) if mask else None
+
+def close_volumes():
+    """Close what open_volumes opened."""
+    global _volumes
+    vols, mask = _volumes
+    for vol in vols + ([mask] if mask else []):
+        vol.closeVolume()
+    _volumes = None
+
+def read_block(vols, start, count):
+    """The voxels of a block of slabs of every volume, one row per volume."""
+    return np.array([np.asarray(vol.getHyperslab(start, count), dtype=float).ravel() for vol in vols])
+
+def fit_block(start, design, slab, sizes):
+    """
+    Fit the linear model to every voxel of slabs [start, start + slab) at once: the coefficients are one
+    product with the design's pseudoinverse, and their standard errors come from the residuals.
+    """
+    vols, mask = _volumes
+    count = (min(slab, sizes[0] - start),) + tuple(sizes[1:])
+    Y = read_block(vols, (start, 0, 0), count)
+    n, p = design.shape
+    coefficients = np.linalg.pinv(design) @ Y
+    residuals = Y - design @ coefficients
+    variance = (residuals ** 2).sum(axis=0) / (n - p)
+    standard_errors = np.sqrt(np.outer(np.diag(np.linalg.pinv(design.T @ design)), variance))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tstats = np.where(standard_errors > 0, coefficients / standard_errors, 0)
+    if mask is not None:
+        inside = read_block([mask], (start, 0, 0), count)[0] > 0.5
+        coefficients[:, ~inside] = 0
+        tstats[:, ~inside] = 0
+    return start, coefficients.reshape((p,) + count), tstats.reshape((p,) + count)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit a linear model at every voxel of the volumes listed in a "
+                                                 "TVBM analysis.csv, reading them a block at a time, and write "
+                                                 "a coefficient and a t-statistic volume for every term.")
+    parser.add_argument("analysis_csv", type=str)
+    parser.add_argument("output_prefix", type=str)
+    parser.add_argument("--predictors", dest="predictors", type=str, nargs="+", required=True,
+                        help="Columns of the csv to use as predictors (an intercept is always included)")
+    parser.add_argument("--column", dest="column", type=str, default="count_targetspace_MincAtom",
+                        help="Column of the csv with the volumes to model [default = %(default)s]")
+    parser.add_argument("--mask", dest="mask", type=str, default=None,
+                        help="Only fit voxels inside this mask")
+    parser.add_argument("--block-size", dest="block_size", type=int, default=2 ** 18,
+                        help="Voxels per volume in each block [default = %(default)s]")
+    parser.add_argument("--processes", dest="processes", type=int, default=1,
+                        help="Number of blocks fitted in parallel [default = %(default)s]")
+    args = parser.parse_args()
+
+    analysis = pd.read_csv(args.analysis_csv)
+    # TVBM writes the paths relative to where it ran, which is where it writes the csv
+    paths = [os.path.join(os.path.dirname(os.path.abspath(args.analysis_csv)), path) for path in analysis[args.column]]
+    design, terms = design_matrix(analysis, args.predictors)
+    if np.linalg.matrix_rank(design) < design.shape[1]:
+        parser.error("the design matrix is rank deficient: %s" % ", ".join(terms))
+    if len(design) <= design.shape[1]:
+        parser.error("%d subjects are too few to fit %d terms" % (len(design), design.shape[1]))
+
+    sizes = tuple(minc_header(paths[0]).sizes[:3])
+    slab = max(1, args.block_size // int(np.prod(sizes[1:])))
+
+    fit = functools.partial(fit_block, design=design, slab=slab, sizes=sizes)
+    # the workers open the inputs themselves, once each, and the pool is started before any output is
+    # created so that no worker inherits an open output
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes, initializer=open_volumes, initargs=(paths, args.mask))
+    else:
+        pool = None
+        open_volumes(paths, args.mask)
+
+    outputs = {}
+    for term in terms:
+        name = re.sub(r"[^A-Za-z0-9.-]+", "_", term)
+        for statistic in ("coefficient", "tstat"):
+            outputs[term, statistic] = volumeLikeFile(paths[0], "%s_%s_%s.mnc" % (args.output_prefix, name, statistic),
+                                                      volumeType="float")
+
+    # each block is written to its hyperslab of every output as soon as it is fitted
+    for start, coefficients, tstats in (pool.imap_unordered if pool else map)(fit, range(0, sizes[0], slab)):
+        for term, coefficient, tstat in zip(terms, coefficients, tstats):
+            for statistic, values in (("coefficient", coefficient), ("tstat", tstat)):
+                outputs[term, statistic].setHyperslab(values, start=(start, 0, 0), count=values.shape)
+        print("Fitted slabs %d to %d of %d" % (start, start + coefficients.shape[1], sizes[0]))
+    if pool:
+        pool.close()
+        pool.join()
+    else:
+        close_volumes()
+    for vol in outputs.values():
+        vol.closeVolume()